@@ -14,10 +14,7 @@ def logger_plugin(callback):
     def wrapper(*args, **kwargs):
         actual_response = callback(*args, **kwargs)
         if not request.url.endswith("/health"):
-            logging.info('%s %s %s %s' % (request.remote_addr,
-                                          request.method,
-                                          request.url,
-                                          response.status))
+            logging.info('%s %s %s %s', request.remote_addr, request.method, request.url, response.status)
         return actual_response
 
     return wrapper
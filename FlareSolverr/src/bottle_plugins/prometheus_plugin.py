@@ -3,16 +3,29 @@ import os
 import urllib.parse
 
 from bottle import request
-from dtos import V1RequestBase, V1ResponseBase
-from metrics import start_metrics_http_server, REQUEST_COUNTER, REQUEST_DURATION
+from dtos import V1RequestBase, V1ResponseBase, get_result
+from metrics import PROMETHEUS_ENABLED, DomainLabels, start_browser_sampler, start_metrics_http_server
+from supervisor import is_worker
+from utils import get_live_dirs
 
-PROMETHEUS_ENABLED = os.environ.get('PROMETHEUS_ENABLED', 'false').lower() == 'true'
 PROMETHEUS_PORT = int(os.environ.get('PROMETHEUS_PORT', 8192))
+PROMETHEUS_MAX_DOMAINS = int(os.environ.get('PROMETHEUS_MAX_DOMAINS', 100))
+PROMETHEUS_DOMAINS = [domain.strip() for domain in os.environ.get('PROMETHEUS_DOMAINS', '').split(',')
+                      if domain.strip()]
+PROMETHEUS_DOMAIN_REGISTRABLE = os.environ.get('PROMETHEUS_DOMAIN_REGISTRABLE', 'false').lower() == 'true'
+# the controllers save the request and the response objects in the WSGI environ
+ENVIRON_REQUEST = 'flaresolverr.request'
+ENVIRON_RESPONSE = 'flaresolverr.response'
+
+DOMAIN_LABELS = DomainLabels(PROMETHEUS_MAX_DOMAINS, PROMETHEUS_DOMAINS, PROMETHEUS_DOMAIN_REGISTRABLE)
 
 
 def setup():
-    if PROMETHEUS_ENABLED:
+    # in multi-process mode the supervisor exports the metrics of all the workers
+    if PROMETHEUS_ENABLED and not is_worker():
         start_metrics_http_server(PROMETHEUS_PORT)
+    if PROMETHEUS_ENABLED:
+        start_browser_sampler(get_live_dirs)
 
 
 def prometheus_plugin(callback):
@@ -23,44 +36,37 @@ def prometheus_plugin(callback):
     def wrapper(*args, **kwargs):
         actual_response = callback(*args, **kwargs)
 
-        if PROMETHEUS_ENABLED:
-            try:
-                export_metrics(actual_response)
-            except Exception as e:
-                logging.warning("Error exporting metrics: " + str(e))
+        # the items of the streamed responses (request.batch) are exported as they finish
+        if isinstance(actual_response, dict):
+            export_metrics(request.environ.get(ENVIRON_REQUEST), request.environ.get(ENVIRON_RESPONSE))
 
         return actual_response
 
-    def export_metrics(actual_response):
-        res = V1ResponseBase(actual_response)
-
-        if res.startTimestamp is None or res.endTimestamp is None:
-            # skip management and healthcheck endpoints
-            return
-
-        domain = "unknown"
-        if res.solution and res.solution.url:
-            domain = parse_domain_url(res.solution.url)
-        else:
-            # timeout error
-            req = V1RequestBase(request.json)
-            if req.url:
-                domain = parse_domain_url(req.url)
-
-        run_time = (res.endTimestamp - res.startTimestamp) / 1000
-        REQUEST_DURATION.labels(domain=domain).observe(run_time)
-
-        result = "unknown"
-        if res.message == "Challenge solved!":
-            result = "solved"
-        elif res.message == "Challenge not detected!":
-            result = "not_detected"
-        elif res.message.startswith("Error"):
-            result = "error"
-        REQUEST_COUNTER.labels(domain=domain, result=result).inc()
-
-    def parse_domain_url(url):
-        parsed_url = urllib.parse.urlparse(url)
-        return parsed_url.hostname
-
     return wrapper
+
+
+def export_metrics(req: V1RequestBase, res: V1ResponseBase):
+    """Exports the metrics of a request, also used by the requests executed outside bottle
+    (the items of request.batch and the asynchronous jobs)"""
+    if not PROMETHEUS_ENABLED:
+        return
+    try:
+        _export_metrics(req, res)
+    except Exception as e:
+        logging.warning("Error exporting metrics: " + str(e))
+
+
+def _export_metrics(req: V1RequestBase, res: V1ResponseBase):
+    if res is None or res.startTimestamp is None or res.endTimestamp is None or res.job is not None:
+        # skip management, healthcheck and asynchronous job endpoints
+        return
+
+    url = None
+    if res.solution and res.solution.url:
+        url = res.solution.url
+    elif req is not None and req.url:
+        # timeout error
+        url = req.url
+
+    run_time = (res.endTimestamp - res.startTimestamp) / 1000
+    DOMAIN_LABELS.observe(urllib.parse.urlparse(url).hostname if url else None, get_result(res.message), run_time)
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+import utils
+from metrics import BROWSER_RECYCLES, POOL_BROWSERS
+
+
+class _IdleBrowser:
+    def __init__(self, driver: WebDriver, proxy_key: str):
+        self.driver = driver
+        self.proxy_key = proxy_key
+        self.released_at = time.time()
+
+
+class BrowserPool:
+    """BrowserPool keeps the browsers of the requests without session alive after the request,
+    indexed by proxy. The proxy is set when the browser is launched, so a browser can only be
+    reused by requests with the same proxy, unless the proxy forwarder is enabled.
+    The pool is disabled when max_size is 0."""
+
+    def __init__(self, max_size: int, idle_seconds: int):
+        self.max_size = max_size
+        self.idle_seconds = idle_seconds
+        # proxy key => idle browsers, the last released at the end
+        self.idle = {}
+        # leased browsers
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.housekeeping = None
+
+    def lease(self, proxy: dict = None) -> WebDriver:
+        proxy_key = self._proxy_key(proxy)
+        while True:
+            with self.lock:
+                browsers = self.idle.get(proxy_key)
+                browser = browsers.pop() if browsers else None
+                if browsers is not None and not browsers:
+                    del self.idle[proxy_key]
+                self._update_gauges()
+            if browser is None:
+                break
+            if _is_alive(browser.driver):
+                utils.set_webdriver_proxy(browser.driver, proxy)
+                logging.debug('Idle instance of webdriver has been reused to perform the request')
+                self._add_busy(1)
+                return browser.driver
+            utils.quit_webdriver(browser.driver)
+
+        driver = utils.get_webdriver(proxy)
+        logging.debug('New instance of webdriver has been created to perform the request')
+        self._add_busy(1)
+        return driver
+
+    def release(self, driver: WebDriver, proxy: dict = None, reusable: bool = True):
+        self._add_busy(-1)
+        if self.max_size <= 0 or not reusable or not _reset(driver):
+            utils.quit_webdriver(driver)
+            if self.max_size > 0:
+                BROWSER_RECYCLES.labels(owner='pool').inc()
+            logging.debug('A used instance of webdriver has been destroyed')
+            return
+
+        evicted = None
+        with self.lock:
+            browser = _IdleBrowser(driver, self._proxy_key(proxy))
+            self.idle.setdefault(browser.proxy_key, []).append(browser)
+            if self.size() > self.max_size:
+                evicted = self._pop_oldest()
+            self._update_gauges()
+            self._start_housekeeping()
+        if evicted is not None:
+            utils.quit_webdriver(evicted.driver)
+        logging.debug('A used instance of webdriver has been returned to the pool')
+
+    def size(self) -> int:
+        return sum(len(browsers) for browsers in self.idle.values())
+
+    def close(self):
+        with self.lock:
+            browsers = [browser for browsers in self.idle.values() for browser in browsers]
+            self.idle = {}
+            self._update_gauges()
+        if browsers:
+            with ThreadPoolExecutor(max_workers=len(browsers), thread_name_prefix='browser-pool-close') as executor:
+                executor.map(lambda browser: utils.quit_webdriver(browser.driver), browsers)
+
+    @staticmethod
+    def _proxy_key(proxy: dict = None) -> str:
+        # with the proxy forwarder all the browsers can be used with any proxy
+        return '' if utils.get_config_proxy_forwarder() else utils.get_proxy_key(proxy)
+
+    def _add_busy(self, count: int):
+        with self.lock:
+            self.busy += count
+            self._update_gauges()
+
+    def _update_gauges(self):
+        POOL_BROWSERS.labels(state='idle').set(self.size())
+        POOL_BROWSERS.labels(state='busy').set(self.busy)
+
+    def _pop_oldest(self) -> _IdleBrowser | None:
+        oldest = None
+        for browsers in self.idle.values():
+            if browsers and (oldest is None or browsers[0].released_at < oldest.released_at):
+                oldest = browsers[0]
+        if oldest is not None:
+            browsers = self.idle[oldest.proxy_key]
+            browsers.pop(0)
+            if not browsers:
+                del self.idle[oldest.proxy_key]
+        return oldest
+
+    def _start_housekeeping(self):
+        if self.housekeeping is None and self.idle_seconds > 0:
+            self.housekeeping = threading.Thread(target=self._housekeeping, name='browser-pool', daemon=True)
+            self.housekeeping.start()
+
+    def _housekeeping(self):
+        while True:
+            time.sleep(min(self.idle_seconds, 30))
+            self._expire()
+
+    def _expire(self):
+        """Closes the browsers idle for more than idle_seconds"""
+        expired = []
+        with self.lock:
+            now = time.time()
+            for proxy_key in list(self.idle):
+                browsers = self.idle[proxy_key]
+                expired += [b for b in browsers if now - b.released_at > self.idle_seconds]
+                browsers[:] = [b for b in browsers if now - b.released_at <= self.idle_seconds]
+                if not browsers:
+                    del self.idle[proxy_key]
+            self._update_gauges()
+        for browser in expired:
+            logging.debug('Idle instance of webdriver has expired')
+            utils.quit_webdriver(browser.driver)
+
+
+def _is_alive(driver: WebDriver) -> bool:
+    try:
+        return len(driver.window_handles) > 0
+    except Exception:
+        return False
+
+
+def _reset(driver: WebDriver) -> bool:
+    """Removes the state of the previous request, the browser must look like a new one"""
+    try:
+        handles = driver.window_handles
+        origins = set()
+        for handle in reversed(handles):
+            driver.switch_to.window(handle)
+            origins |= _get_origins(driver)
+            if handle != handles[0]:
+                driver.close()
+        driver.execute_cdp_cmd('Network.setBlockedURLs', {'urls': []})
+        driver.execute_cdp_cmd('Network.clearBrowserCookies', {})
+        driver.execute_cdp_cmd('Network.clearBrowserCache', {})
+        # localStorage, indexedDB, service workers... of every site visited
+        for origin in sorted(origins):
+            driver.execute_cdp_cmd('Storage.clearDataForOrigin', {'origin': origin, 'storageTypes': 'all'})
+        driver.get('about:blank')
+        driver.execute_cdp_cmd('Page.resetNavigationHistory', {})
+        return True
+    except Exception as e:
+        logging.debug(f'Error resetting the webdriver, it will be destroyed. {e}')
+        return False
+
+
+def _get_origins(driver: WebDriver) -> set[str]:
+    """Origins of the frames and the navigation history of the current window"""
+    urls = [entry['url'] for entry in driver.execute_cdp_cmd('Page.getNavigationHistory', {})['entries']]
+    frames = [driver.execute_cdp_cmd('Page.getFrameTree', {})['frameTree']]
+    while frames:
+        frame = frames.pop()
+        urls.append(frame['frame']['url'])
+        frames += frame.get('childFrames', [])
+    origins = set()
+    for url in urls:
+        url = urlparse(url)
+        if url.scheme in ('http', 'https'):
+            origins.add(f'{url.scheme}://{url.netloc}')
+    return origins
@@ -0,0 +1,115 @@
+import logging
+import math
+import threading
+import time
+from typing import Optional
+
+from dtos import MESSAGE_CIRCUIT_OPEN, RESULT_BLOCKED, RESULT_ERROR
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+# results that count as failures, the rest reset the counter
+FAILURE_RESULTS = (RESULT_ERROR, RESULT_BLOCKED)
+# the closed circuits are purged when there are more circuits
+MAX_CIRCUITS = 10000
+
+
+class Circuit:
+    def __init__(self, domain: str, proxy: Optional[str]):
+        self.domain = domain
+        self.proxy = proxy
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.last_result = None
+        self.opened_at = 0.0
+        # in half-open state only one request (probe) is executed
+        self.probing = False
+
+
+class CircuitBreakers:
+    """CircuitBreakers keeps a circuit per domain and per domain + proxy. After 'failures' errors or
+    blocks in a row the circuit opens and the requests fail fast for 'cooldown' seconds. Then one
+    request is allowed (half-open), if it succeeds the circuit closes, if not it opens again.
+    Only the circuits with failures are stored, a closed circuit without failures is the same as a new one.
+    The circuits are disabled when failures is 0."""
+
+    def __init__(self, failures: int, cooldown: int):
+        self.failures = failures
+        self.cooldown = cooldown
+        self.circuits = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, domain: Optional[str], proxy: Optional[dict] = None) -> list[Circuit]:
+        """Returns the circuits of the request or raises an exception if any of them is open.
+        The result of the request must be reported with release()."""
+        if self.failures <= 0 or not domain:
+            return []
+        proxy_url = proxy.get('url') if proxy else None
+        keys = [(domain, None)] + ([(domain, proxy_url)] if proxy_url else [])
+
+        now = time.time()
+        with self.lock:
+            circuits = [self.circuits.get(key) or Circuit(*key) for key in keys]
+            for circuit in circuits:
+                if circuit.state == CIRCUIT_OPEN and now - circuit.opened_at >= self.cooldown:
+                    circuit.state = CIRCUIT_HALF_OPEN
+                if circuit.state == CIRCUIT_OPEN or (circuit.state == CIRCUIT_HALF_OPEN and circuit.probing):
+                    retry_in = max(math.ceil(self.cooldown - (now - circuit.opened_at)), 0)
+                    target = domain if circuit.proxy is None else f'{domain} with proxy {circuit.proxy}'
+                    raise Exception(f"{MESSAGE_CIRCUIT_OPEN} for {target} after {circuit.failures} failures "
+                                    f"({circuit.last_result}). Retry in {retry_in} seconds.")
+            for circuit in circuits:
+                if circuit.state == CIRCUIT_HALF_OPEN:
+                    circuit.probing = True
+        return circuits
+
+    def release(self, circuits: list[Circuit], result: Optional[str]):
+        """Updates the circuits with the result of the request (see dtos.get_result).
+        The result is None if the request was not executed."""
+        with self.lock:
+            for circuit in circuits:
+                circuit.probing = False
+                if result is None:
+                    continue
+                key = (circuit.domain, circuit.proxy)
+                if result not in FAILURE_RESULTS:
+                    if circuit.state != CIRCUIT_CLOSED:
+                        logging.info(f"Circuit closed for {circuit.domain} (proxy={circuit.proxy})")
+                    circuit.state = CIRCUIT_CLOSED
+                    circuit.failures = 0
+                    self.circuits.pop(key, None)
+                    continue
+                if key not in self.circuits and len(self.circuits) >= MAX_CIRCUITS:
+                    self._purge()
+                # the circuits of concurrent requests to a new domain are different objects
+                circuit = self.circuits.setdefault(key, circuit)
+                circuit.last_result = result
+                circuit.failures += 1
+                if circuit.state == CIRCUIT_HALF_OPEN or circuit.failures >= self.failures:
+                    if circuit.state != CIRCUIT_OPEN:
+                        logging.warning(f"Circuit open for {circuit.domain} (proxy={circuit.proxy}) after "
+                                        f"{circuit.failures} failures, last result: {result}")
+                    circuit.state = CIRCUIT_OPEN
+                    circuit.opened_at = time.time()
+
+    def _purge(self):
+        # the closed circuits only have a few failures, the open ones protect the targets
+        for key, circuit in list(self.circuits.items()):
+            if circuit.state == CIRCUIT_CLOSED:
+                del self.circuits[key]
+
+    def list(self) -> list[dict]:
+        now = time.time()
+        with self.lock:
+            return [{
+                "domain": circuit.domain,
+                "proxy": circuit.proxy,
+                "state": CIRCUIT_HALF_OPEN if circuit.state == CIRCUIT_OPEN
+                and now - circuit.opened_at >= self.cooldown else circuit.state,
+                "failures": circuit.failures,
+                "lastResult": circuit.last_result,
+                "retryIn": max(math.ceil(self.cooldown - (now - circuit.opened_at)), 0)
+                if circuit.state == CIRCUIT_OPEN else 0
+            } for circuit in self.circuits.values()]
@@ -0,0 +1,57 @@
+import copy
+import threading
+from typing import Any, Callable, Optional
+
+from metrics import REQUEST_COALESCING_COUNTER
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.followers = 0
+        self.result = None
+        self.error = None
+
+
+class RequestCoalescer:
+    """RequestCoalescer executes only once the identical requests that are in flight at the same time
+    (single-flight). The first request (leader) does the work, the rest (followers) wait for it
+    and get a copy of the result or the same exception. A follower that doesn't get the result in
+    its timeout raises TimeoutError."""
+
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], Any], timeout: Optional[float] = None) -> Any:
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self.calls[key] = call
+            else:
+                call.followers += 1
+
+        if not leader:
+            REQUEST_COALESCING_COUNTER.labels(role='follower').inc()
+            if not call.event.wait(timeout):
+                raise TimeoutError(f'Timeout after {timeout} seconds waiting for an identical request.')
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+
+        REQUEST_COALESCING_COUNTER.labels(role='leader').inc()
+        try:
+            result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            # the leader may modify its result, the followers get a snapshot
+            if call.error is None and call.followers > 0:
+                call.result = copy.deepcopy(result)
+            call.event.set()
+        return result
@@ -2,6 +2,39 @@
 STATUS_OK = "ok"
 STATUS_ERROR = "error"
 
+MESSAGE_SOLVED = "Challenge solved!"
+MESSAGE_NOT_DETECTED = "Challenge not detected!"
+MESSAGE_BLOCKED = "Cloudflare has blocked this request."
+MESSAGE_CIRCUIT_OPEN = "Circuit breaker open"
+MESSAGE_RATE_LIMITED = "Rate limit exceeded"
+
+RESULT_SOLVED = "solved"
+RESULT_NOT_DETECTED = "not_detected"
+RESULT_BLOCKED = "blocked"
+RESULT_CIRCUIT_OPEN = "circuit_open"
+RESULT_RATE_LIMITED = "rate_limited"
+RESULT_ERROR = "error"
+RESULT_UNKNOWN = "unknown"
+RESULTS = (RESULT_SOLVED, RESULT_NOT_DETECTED, RESULT_BLOCKED, RESULT_CIRCUIT_OPEN, RESULT_RATE_LIMITED, RESULT_ERROR,
+           RESULT_UNKNOWN)
+
+
+def get_result(message: str | None) -> str:
+    """Classifies the result of a request by its response message"""
+    if message == MESSAGE_SOLVED:
+        return RESULT_SOLVED
+    if message == MESSAGE_NOT_DETECTED:
+        return RESULT_NOT_DETECTED
+    if message and message.startswith("Error"):
+        if MESSAGE_BLOCKED in message:
+            return RESULT_BLOCKED
+        if MESSAGE_CIRCUIT_OPEN in message:
+            return RESULT_CIRCUIT_OPEN
+        if MESSAGE_RATE_LIMITED in message:
+            return RESULT_RATE_LIMITED
+        return RESULT_ERROR
+    return RESULT_UNKNOWN
+
 
 class ChallengeResolutionResultT:
     url: str = None
@@ -39,8 +72,22 @@ class V1RequestBase(object):
     headers: list = None  # deprecated v2.0.0, not used
     userAgent: str = None  # deprecated v2.0.0, not used
 
+    # V1SessionsForkRequest
+    count: int = None
+
+    # V1BatchRequest
+    requests: list = None
+    concurrency: int = None
+
+    # V1AsyncRequest ('async' is a reserved word, use getattr(req, 'async', None))
+    callbackUrl: str = None
+
     # V1Request
     url: str = None
+    # higher priority requests are executed first when the solves are limited (MAX_CONCURRENT_SOLVES)
+    priority: int = None
+    # client tag, the requests with different tags share the solves fairly
+    tag: str = None
     postData: str = None
     returnOnlyCookies: bool = None
     returnScreenshot: bool = None
@@ -51,6 +98,8 @@ class V1RequestBase(object):
     disableMedia: bool = None
     # Optional when you've got a turnstile captcha that needs to be clicked after X number of Tab presses
     tabs_till_verify : int = None
+    # return the duration of the phases of the request (timings and Server-Timing header)
+    returnTimings: bool = None
 
     def __init__(self, _dict):
         self.__dict__.update(_dict)
@@ -68,9 +117,23 @@ class V1ResponseBase(object):
 
     # V1ResponseSolution
     solution: ChallengeResolutionResultT = None
+    # median solve time of the domain in milliseconds
+    expectedSolveTime: int = None
+    # seconds to wait before retrying a request rejected by the rate limits
+    retryAfter: int = None
+    # milliseconds of the phases of the request (returnTimings)
+    timings: dict = None
+
+    # V1BatchResponseItem
+    index: int = None
+
+    # V1AsyncResponse
+    job: str = None
 
     # hidden vars
     __error_500__: bool = False
+    # iterator of V1ResponseBase, the items of request.batch
+    __stream__ = None
 
     def __init__(self, _dict):
         self.__dict__.update(_dict)
@@ -78,6 +141,15 @@ class V1ResponseBase(object):
             self.solution = ChallengeResolutionResultT(self.solution)
 
 
+class JobResponse(object):
+    job: str = None
+    status: str = None
+    result: dict = None
+
+    def __init__(self, _dict):
+        self.__dict__.update(_dict)
+
+
 class IndexResponse(object):
     msg: str = None
     version: str = None
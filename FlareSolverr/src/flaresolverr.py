@@ -1,16 +1,25 @@
+import _thread
 import json
 import logging
 import os
+import signal
 import sys
+import threading
+import time
 
 import certifi
-from bottle import run, response, Bottle, request, ServerAdapter
+from bottle import run, response, Bottle, request, ServerAdapter, static_file
 
 from bottle_plugins.error_plugin import error_plugin
 from bottle_plugins.logger_plugin import logger_plugin
 from bottle_plugins import prometheus_plugin
-from dtos import V1RequestBase
+from dtos import STATUS_ERROR, V1RequestBase
+from metrics import phase
+from timings import server_timing
 import flaresolverr_service
+import logs
+import reaper
+import supervisor
 import utils
 
 env_proxy_url = os.environ.get('PROXY_URL', None)
@@ -46,6 +55,10 @@ def health():
     This endpoint is special because it doesn't print traces
     """
     res = flaresolverr_service.health_endpoint()
+    if flaresolverr_service.is_draining():
+        # the load balancers must stop sending requests
+        response.status = 503
+        res.status = STATUS_ERROR
     return utils.object_to_dict(res)
 
 
@@ -54,6 +67,9 @@ def controller_v1():
     """
     Controller v1
     """
+    if flaresolverr_service.is_draining():
+        response.status = 503
+        return dict(status=STATUS_ERROR, message="Error: FlareSolverr is shutting down.")
     data = request.json or {}
     if (('proxy' not in data or not data.get('proxy')) and env_proxy_url is not None and (env_proxy_username is None and env_proxy_password is None)):
         logging.info('Using proxy URL ENV')
@@ -63,11 +79,122 @@ def controller_v1():
         data['proxy'] = {"url": env_proxy_url, "username": env_proxy_username, "password": env_proxy_password}
     req = V1RequestBase(data)
     res = flaresolverr_service.controller_v1_endpoint(req)
+    # used by the plugins
+    request.environ[prometheus_plugin.ENVIRON_REQUEST] = req
+    request.environ[prometheus_plugin.ENVIRON_RESPONSE] = res
     if res.__error_500__:
-        response.status = 500
+        # the requests rejected by the rate limits can be retried later (Retry-After)
+        response.status = 429 if res.retryAfter is not None else 500
+    if res.retryAfter is not None:
+        response.set_header('Retry-After', str(res.retryAfter))
+    if res.__stream__ is not None:
+        # newline delimited JSON, one line per item as soon as it's completed
+        response.content_type = 'application/x-ndjson'
+        return (json.dumps(utils.object_to_dict(item)) + '\n' for item in res.__stream__)
+    serialization_start = time.perf_counter()
+    with phase('serialization'):
+        body = utils.object_to_dict(res)
+    if res.timings is not None:
+        # the timings of the body are computed before the serialization, only the header includes it
+        response.set_header('Server-Timing', server_timing(res.timings, time.perf_counter() - serialization_start))
+    return body
+
+
+@app.route('/v1/circuits')
+def circuits():
+    """
+    State of the circuit breakers by domain and domain + proxy
+    """
+    return flaresolverr_service.circuits_endpoint()
+
+
+@app.route('/v1/recordings')
+def recordings():
+    """
+    Recordings of the flight recorder (failed and slow requests), the newest first
+    """
+    return flaresolverr_service.recordings_endpoint()
+
+
+@app.route('/v1/recordings/<recording_id>')
+def recording(recording_id):
+    """
+    Recording of the flight recorder with the HTML
+    """
+    res = flaresolverr_service.recording_endpoint(recording_id)
+    if res is None:
+        response.status = 404
+        return dict(error=f"Recording '{recording_id}' not found.", status_code=404)
+    return res
+
+
+@app.route('/v1/recordings/<recording_id>/screenshot')
+def recording_screenshot(recording_id):
+    """
+    Screenshot of a recording of the flight recorder (JPEG)
+    """
+    path = flaresolverr_service.recording_screenshot_endpoint(recording_id)
+    if path is None:
+        response.status = 404
+        return dict(error=f"Screenshot of recording '{recording_id}' not found.", status_code=404)
+    return static_file(os.path.basename(path), root=os.path.dirname(path), mimetype='image/jpeg')
+
+
+@app.route('/v1/profiler')
+def profiler():
+    """
+    State of the profiler and list of profiles
+    """
+    return flaresolverr_service.profiler_endpoint()
+
+
+@app.post('/v1/profiler')
+def profiler_start():
+    """
+    Starts the profiler for N seconds ({"seconds": N}) or for the next N requests ({"requests": N})
+    """
+    data = request.json or {}
+    seconds = float(data['seconds']) if data.get('seconds') is not None else None
+    requests = int(data['requests']) if data.get('requests') is not None else None
+    return flaresolverr_service.profiler_start_endpoint(seconds, requests)
+
+
+@app.route('/v1/profiler/<name>')
+def profiler_file(name):
+    """
+    Profile in collapsed stacks format (flamegraph.pl, speedscope...)
+    """
+    path = flaresolverr_service.profiler_file_endpoint(name)
+    if path is None:
+        response.status = 404
+        return dict(error=f"Profile '{name}' not found.", status_code=404)
+    return static_file(os.path.basename(path), root=os.path.dirname(path), mimetype='text/plain')
+
+
+@app.route('/v1/jobs/<job_id>')
+def jobs(job_id):
+    """
+    Status and result of an asynchronous request.
+    The 'wait' query parameter waits up to N seconds until the job is done (long-poll).
+    """
+    wait = float(request.query.get('wait', 0))
+    res = flaresolverr_service.jobs_endpoint(job_id, wait)
+    if res is None:
+        response.status = 404
+        return dict(error=f"Job '{job_id}' not found.", status_code=404)
     return utils.object_to_dict(res)
 
 
+def shutdown(signum, frame):
+    # the requests in progress need the server running to send their responses
+    def drain():
+        flaresolverr_service.shutdown(utils.get_config_shutdown_grace_seconds())
+        # stops the server (KeyboardInterrupt in the main thread)
+        _thread.interrupt_main()
+    logging.info(f"Signal {signal.Signals(signum).name} received")
+    threading.Thread(target=drain, name='shutdown', daemon=True).start()
+
+
 if __name__ == "__main__":
     # check python version
     if sys.version_info < (3, 9):
@@ -97,28 +224,15 @@ if __name__ == "__main__":
     logger_format = '%(asctime)s %(levelname)-8s %(message)s'
     if log_level == 'DEBUG':
         logger_format = '%(asctime)s %(levelname)-8s ReqId %(thread)s %(message)s'
+    if supervisor.is_worker():
+        logger_format = logger_format.replace('%(message)s', f'Worker {supervisor.WORKER_ID} %(message)s')
+    log_handlers = [logging.StreamHandler(sys.stdout)]
     if log_file:
         log_file = os.path.realpath(log_file)
         log_path = os.path.dirname(log_file)
         os.makedirs(log_path, exist_ok=True)
-        logging.basicConfig(
-            format=logger_format,
-            level=log_level,
-            datefmt='%Y-%m-%d %H:%M:%S',
-            handlers=[
-                logging.StreamHandler(sys.stdout),
-                logging.FileHandler(log_file)
-            ]
-        )
-    else:
-        logging.basicConfig(
-            format=logger_format,
-            level=log_level,
-            datefmt='%Y-%m-%d %H:%M:%S',
-            handlers=[
-                logging.StreamHandler(sys.stdout)
-            ]
-        )
+        log_handlers.append(logging.FileHandler(log_file))
+    logs.setup(log_level, logger_format, log_handlers, supervisor.WORKER_ID)
 
     # disable warning traces from urllib3
     logging.getLogger('urllib3').setLevel(logging.ERROR)
@@ -128,9 +242,19 @@ if __name__ == "__main__":
     logging.info(f'FlareSolverr {utils.get_flaresolverr_version()}')
     logging.debug('Debug log enabled')
 
+    # multi-process mode, the workers are started with the WORKER_ID env var
+    workers = utils.get_config_workers()
+    if workers > 1 and not supervisor.is_worker():
+        prometheus_port = prometheus_plugin.PROMETHEUS_PORT if prometheus_plugin.PROMETHEUS_ENABLED else None
+        supervisor.run(server_host, server_port, workers, prometheus_port)
+        sys.exit(0)
+
     # Get current OS for global variable
     utils.get_current_platform()
 
+    # kill the browsers left behind by previous executions and check them periodically
+    reaper.Reaper(utils.get_config_reaper_interval_seconds()).start()
+
     # test browser installation
     flaresolverr_service.test_browser_installation()
 
@@ -145,6 +269,8 @@ if __name__ == "__main__":
     # default server 'wsgiref' does not support concurrent requests
     # https://github.com/FlareSolverr/FlareSolverr/issues/680
     # https://github.com/Pylons/waitress/issues/31
+    signal.signal(signal.SIGTERM, shutdown)
+
     class WaitressServerPoll(ServerAdapter):
         def run(self, handler):
             from waitress import serve
@@ -1,10 +1,15 @@
+import contextvars
+import json
 import logging
+import math
 import platform
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 from html import escape
-from urllib.parse import unquote, quote
+from urllib.parse import unquote, quote, urlparse
 
 from func_timeout import FunctionTimedOut, func_timeout
 from selenium.common import TimeoutException
@@ -17,10 +22,25 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.webdriver.support.wait import WebDriverWait
 
 import utils
-from dtos import (STATUS_ERROR, STATUS_OK, ChallengeResolutionResultT,
+from bottle_plugins.prometheus_plugin import export_metrics
+from browser_pool import BrowserPool
+from circuit_breaker import CircuitBreakers
+from coalescing import RequestCoalescer
+from dtos import (MESSAGE_BLOCKED, MESSAGE_NOT_DETECTED, MESSAGE_SOLVED,
+                  STATUS_ERROR, STATUS_OK, ChallengeResolutionResultT,
                   ChallengeResolutionT, HealthResponse, IndexResponse,
-                  V1RequestBase, V1ResponseBase)
+                  JobResponse, V1RequestBase, V1ResponseBase, get_result)
+from flight_recorder import FlightRecorder
+from jobs import JobsStorage
+from logs import LogPayload, LogText
+from metrics import observe_phase, phase
+from profiler import Profiler
+from proxy_registry import ProxyRegistry
+from rate_limiter import RateLimiter, RateLimitException
+from scheduler import Scheduler
 from sessions import SessionsStorage
+from solve_times import SolveTimes
+from timings import TIMINGS, Timings
 
 ACCESS_DENIED_TITLES = [
     # Cloudflare
@@ -55,6 +75,32 @@ TURNSTILE_SELECTORS = [
 
 SHORT_TIMEOUT = 1
 SESSIONS_STORAGE = SessionsStorage()
+BROWSER_POOL = BrowserPool(utils.get_config_browser_pool_size(), utils.get_config_browser_pool_idle_seconds())
+REQUEST_COALESCER = RequestCoalescer()
+JOBS_STORAGE = JobsStorage(utils.get_config_jobs_max_concurrency(), utils.get_config_jobs_max(),
+                           utils.get_config_jobs_ttl_seconds())
+PROXY_REGISTRY = ProxyRegistry(utils.get_config_proxy_pools(), utils.get_config_proxy_health_check_url(),
+                               utils.get_config_proxy_health_check_seconds(), utils.get_config_proxy_eject_blocks(),
+                               utils.get_config_proxy_eject_minutes())
+SOLVE_TIMES = SolveTimes(utils.get_config_adaptive_timeout(), utils.get_config_adaptive_timeout_quantile(),
+                         utils.get_config_adaptive_timeout_margin(), utils.get_config_adaptive_timeout_min_samples())
+RATE_LIMITER = RateLimiter(utils.get_config_rate_limit_domain(), utils.get_config_rate_limit_proxy(),
+                           utils.get_config_rate_limit_domain_proxy(), utils.get_config_rate_limit_burst())
+SCHEDULER = Scheduler(utils.get_config_max_concurrent_solves(), utils.get_config_domain_max_concurrency(),
+                      utils.get_config_scheduler_weights())
+CIRCUIT_BREAKERS = CircuitBreakers(utils.get_config_circuit_breaker_failures(),
+                                   utils.get_config_circuit_breaker_cooldown_seconds())
+FLIGHT_RECORDER = FlightRecorder(utils.get_config_flight_recorder(), utils.get_config_flight_recorder_dir(),
+                                 utils.get_config_flight_recorder_slow_seconds(),
+                                 utils.get_config_flight_recorder_max_mb() * 1024 * 1024,
+                                 utils.get_config_flight_recorder_html_kb() * 1024,
+                                 utils.get_config_flight_recorder_screenshot())
+PROFILER = Profiler(utils.get_config_profiles_dir(), utils.get_config_profiles_max_files())
+
+# requests in progress, see shutdown()
+IN_FLIGHT = 0
+IN_FLIGHT_CONDITION = threading.Condition()
+DRAINING = threading.Event()
 
 
 def test_browser_installation():
@@ -95,27 +141,122 @@ def health_endpoint() -> HealthResponse:
     return res
 
 
-def controller_v1_endpoint(req: V1RequestBase) -> V1ResponseBase:
+def controller_v1_endpoint(req: V1RequestBase, counted: bool = False) -> V1ResponseBase:
+    """
+    counted is True if the request is already counted in IN_FLIGHT (the items of request.batch)
+    """
     start_ts = int(time.time() * 1000)
-    logging.info(f"Incoming request => POST /v1 body: {utils.object_to_dict(req)}")
+    logging.info("Incoming request => POST /v1 body: %s", LogPayload(req))
     res: V1ResponseBase
+    # the debug log and the flight recorder include the timings and the WebDriver commands of the request
+    timings = Timings() if req.returnTimings or FLIGHT_RECORDER.enabled or \
+        logging.getLogger().isEnabledFor(logging.DEBUG) else None
+    timings_token = TIMINGS.set(timings)
+    if not counted:
+        _add_in_flight(1)
     try:
-        res = _controller_v1_handler(req)
+        with PROFILER.request():
+            res = _controller_v1_handler(req)
     except Exception as e:
         res = V1ResponseBase({})
         res.__error_500__ = True
         res.status = STATUS_ERROR
         res.message = "Error: " + str(e)
+        if isinstance(e, RateLimitException):
+            res.retryAfter = math.ceil(e.retry_after)
         logging.error(res.message)
+    finally:
+        TIMINGS.reset(timings_token)
+        _add_in_flight(-1)
 
+    if timings is not None and timings.commands and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("WebDriver commands: %s", timings.commands_summary())
+    if req.returnTimings and res.__stream__ is None and res.job is None:
+        res.timings = timings.to_dict()
     res.startTimestamp = start_ts
     res.endTimestamp = int(time.time() * 1000)
     res.version = utils.get_flaresolverr_version()
-    logging.debug(f"Response => POST /v1 body: {utils.object_to_dict(res)}")
+    logging.debug("Response => POST /v1 body: %s", LogPayload(res))
     logging.info(f"Response in {(res.endTimestamp - res.startTimestamp) / 1000} s")
     return res
 
 
+def circuits_endpoint() -> dict:
+    return {"status": STATUS_OK, "circuits": CIRCUIT_BREAKERS.list()}
+
+
+def recordings_endpoint() -> dict:
+    return {"status": STATUS_OK, "recordings": FLIGHT_RECORDER.list()}
+
+
+def recording_endpoint(recording_id: str) -> dict | None:
+    return FLIGHT_RECORDER.get(recording_id)
+
+
+def recording_screenshot_endpoint(recording_id: str) -> str | None:
+    return FLIGHT_RECORDER.get_screenshot(recording_id)
+
+
+def profiler_endpoint() -> dict:
+    return {"status": STATUS_OK, **PROFILER.status()}
+
+
+def profiler_start_endpoint(seconds: float = None, requests: int = None) -> dict:
+    return {"status": STATUS_OK, **PROFILER.start(seconds, requests)}
+
+
+def profiler_file_endpoint(name: str) -> str | None:
+    return PROFILER.get_file(name)
+
+
+def is_draining() -> bool:
+    return DRAINING.is_set()
+
+
+def _add_in_flight(count: int):
+    global IN_FLIGHT
+    with IN_FLIGHT_CONDITION:
+        IN_FLIGHT += count
+        IN_FLIGHT_CONDITION.notify_all()
+
+
+def shutdown(grace_seconds: float):
+    """
+    Graceful shutdown. The new requests are rejected (see is_draining), the requests in progress and the
+    asynchronous jobs have grace_seconds to finish, then all the browsers are closed in parallel.
+    """
+    DRAINING.set()
+    deadline = time.time() + grace_seconds
+    logging.info(f"Shutting down, waiting up to {grace_seconds} seconds for the requests in progress...")
+    with IN_FLIGHT_CONDITION:
+        while (IN_FLIGHT > 0 or JOBS_STORAGE.pending() > 0) and time.time() < deadline:
+            # the jobs don't notify the condition
+            IN_FLIGHT_CONDITION.wait(min(deadline - time.time(), 1))
+        if IN_FLIGHT > 0 or JOBS_STORAGE.pending() > 0:
+            logging.warning(f"Shutdown grace period expired with {IN_FLIGHT} requests and "
+                            f"{JOBS_STORAGE.pending()} jobs in progress")
+
+    session_ids = SESSIONS_STORAGE.session_ids()
+    logging.info(f"Closing {len(session_ids)} sessions and {BROWSER_POOL.size()} idle browsers...")
+    with ThreadPoolExecutor(max_workers=max(len(session_ids), 1) + 1, thread_name_prefix='shutdown') as executor:
+        executor.submit(BROWSER_POOL.close)
+        for session_id in session_ids:
+            executor.submit(SESSIONS_STORAGE.destroy, session_id)
+    logging.info("Shutdown completed")
+
+
+def jobs_endpoint(job_id: str, wait: float = 0) -> JobResponse | None:
+    # long-poll is limited to avoid holding the connection forever
+    job = JOBS_STORAGE.get(job_id, min(max(wait, 0), 300))
+    if job is None:
+        return None
+    res = JobResponse({})
+    res.job = job.job_id
+    res.status = job.status
+    res.result = job.result
+    return res
+
+
 def _controller_v1_handler(req: V1RequestBase) -> V1ResponseBase:
     # do some validations
     if req.cmd is None:
@@ -131,16 +272,22 @@ def _controller_v1_handler(req: V1RequestBase) -> V1ResponseBase:
 
     # execute the command
     res: V1ResponseBase
-    if req.cmd == 'sessions.create':
+    if getattr(req, 'async', None):
+        res = _cmd_async(req)
+    elif req.cmd == 'sessions.create':
         res = _cmd_sessions_create(req)
     elif req.cmd == 'sessions.list':
         res = _cmd_sessions_list(req)
     elif req.cmd == 'sessions.destroy':
         res = _cmd_sessions_destroy(req)
+    elif req.cmd == 'sessions.fork':
+        res = _cmd_sessions_fork(req)
     elif req.cmd == 'request.get':
         res = _cmd_request_get(req)
     elif req.cmd == 'request.post':
         res = _cmd_request_post(req)
+    elif req.cmd == 'request.batch':
+        res = _cmd_request_batch(req)
     else:
         raise Exception(f"Request parameter 'cmd' = '{req.cmd}' is invalid.")
 
@@ -158,11 +305,12 @@ def _cmd_request_get(req: V1RequestBase) -> V1ResponseBase:
     if req.download is not None:
         logging.warning("Request parameter 'download' was removed in FlareSolverr v2.")
 
-    challenge_res = _resolve_challenge(req, 'GET')
+    challenge_res = _resolve_challenge_coalesced(req, 'GET')
     res = V1ResponseBase({})
     res.status = challenge_res.status
     res.message = challenge_res.message
     res.solution = challenge_res.result
+    _set_expected_solve_time(req, res)
     return res
 
 
@@ -175,18 +323,94 @@ def _cmd_request_post(req: V1RequestBase) -> V1ResponseBase:
     if req.download is not None:
         logging.warning("Request parameter 'download' was removed in FlareSolverr v2.")
 
-    challenge_res = _resolve_challenge(req, 'POST')
+    challenge_res = _resolve_challenge_coalesced(req, 'POST')
     res = V1ResponseBase({})
     res.status = challenge_res.status
     res.message = challenge_res.message
     res.solution = challenge_res.result
+    _set_expected_solve_time(req, res)
+    return res
+
+
+def _set_expected_solve_time(req: V1RequestBase, res: V1ResponseBase):
+    expected = SOLVE_TIMES.expected(urlparse(req.url).hostname)
+    if expected is not None:
+        res.expectedSolveTime = int(expected * 1000)
+
+
+def _cmd_async(req: V1RequestBase) -> V1ResponseBase:
+    # do some validations
+    if req.cmd not in ('request.get', 'request.post'):
+        raise Exception(f"Request parameter 'async' is not supported in '{req.cmd}' command.")
+
+    job_req = V1RequestBase({k: v for k, v in req.__dict__.items() if k != 'async'})
+    job = JOBS_STORAGE.submit(lambda: _run_job(job_req), req.callbackUrl)
+    logging.info(f"Job {job.job_id} created")
+
+    return V1ResponseBase({
+        "status": STATUS_OK,
+        "message": "Job created.",
+        "job": job.job_id
+    })
+
+
+def _run_job(req: V1RequestBase) -> dict:
+    res = controller_v1_endpoint(req)
+    # the job is executed outside bottle, the Prometheus plugin only sees the job id
+    export_metrics(req, res)
+    return utils.object_to_dict(res)
+
+
+def _cmd_request_batch(req: V1RequestBase) -> V1ResponseBase:
+    # do some validations
+    if not isinstance(req.requests, list) or len(req.requests) == 0:
+        raise Exception("Request parameter 'requests' is mandatory in 'request.batch' command.")
+    for item in req.requests:
+        if not isinstance(item, dict) or item.get('cmd') not in ('request.get', 'request.post'):
+            raise Exception("The items of the parameter 'requests' must be 'request.get' or 'request.post' commands.")
+    max_concurrency = utils.get_config_batch_max_concurrency()
+    concurrency = max_concurrency if req.concurrency is None else min(int(req.concurrency), max_concurrency)
+    if concurrency < 1:
+        raise Exception("Request parameter 'concurrency' must be greater than 0.")
+
+    # the parameters of the batch request are the default values of the items
+    defaults = {k: v for k, v in req.__dict__.items() if k not in ('cmd', 'requests', 'concurrency')}
+    items = [V1RequestBase({**defaults, **item}) for item in req.requests]
+
+    res = V1ResponseBase({})
+    res.status = STATUS_OK
+    res.message = f"Batch of {len(items)} requests."
+    res.__stream__ = _batch_stream(items, concurrency)
     return res
 
 
+def _batch_stream(items: list[V1RequestBase], concurrency: int):
+    # the items are returned as soon as they finish, not in order
+    executor = ThreadPoolExecutor(max_workers=min(concurrency, len(items)), thread_name_prefix='batch')
+    # the items waiting in the executor are requests in progress too (shutdown waits for them)
+    _add_in_flight(len(items))
+    futures = {}
+    try:
+        for index, item in enumerate(items):
+            futures[executor.submit(controller_v1_endpoint, item, True)] = index
+        for future in as_completed(futures):
+            item_res = future.result()
+            item_res.index = futures[future]
+            export_metrics(items[item_res.index], item_res)
+            yield item_res
+    finally:
+        # the client may disconnect before the end
+        executor.shutdown(wait=False, cancel_futures=True)
+        # the cancelled items never run, the rest are discounted when they finish
+        _add_in_flight(-(len(items) - len(futures)) - sum(future.cancelled() for future in futures))
+
+
 def _cmd_sessions_create(req: V1RequestBase) -> V1ResponseBase:
     logging.debug("Creating new session...")
 
-    session, fresh = SESSIONS_STORAGE.create(session_id=req.session, proxy=req.proxy)
+    # the proxy of the session is selected once
+    proxy = PROXY_REGISTRY.select(req.proxy, in_flight=False)
+    session, fresh = SESSIONS_STORAGE.create(session_id=req.session, proxy=proxy)
     session_id = session.session_id
 
     if not fresh:
@@ -226,14 +450,63 @@ def _cmd_sessions_destroy(req: V1RequestBase) -> V1ResponseBase:
     })
 
 
+def _cmd_sessions_fork(req: V1RequestBase) -> V1ResponseBase:
+    # do some validations
+    if req.session is None:
+        raise Exception("Request parameter 'session' is mandatory in 'sessions.fork' command.")
+    count = 1 if req.count is None else int(req.count)
+    if count < 1:
+        raise Exception("Request parameter 'count' must be greater than 0.")
+    # each new session launches a browser
+    max_count = utils.get_config_session_fork_max()
+    if count > max_count:
+        raise Exception(f"Request parameter 'count' must be less than or equal to {max_count}.")
+
+    logging.debug(f"Forking session {req.session} into {count} new sessions...")
+    sessions = SESSIONS_STORAGE.fork(req.session, count, int(req.maxTimeout) / 1000)
+
+    return V1ResponseBase({
+        "status": STATUS_OK,
+        "message": "The session has been forked.",
+        "sessions": [session.session_id for session in sessions]
+    })
+
+
+def _resolve_challenge_coalesced(req: V1RequestBase, method: str) -> ChallengeResolutionT:
+    # identical requests without session in flight at the same time are executed only once
+    if req.session or not utils.get_config_request_coalescing():
+        return _resolve_challenge(req, method)
+    key = json.dumps([method, req.url, req.postData, req.proxy, req.cookies, req.returnOnlyCookies,
+                      req.returnScreenshot, req.waitInSeconds, req.disableMedia, req.tabs_till_verify],
+                     sort_keys=True, default=str)
+    timeout = int(req.maxTimeout) / 1000
+    try:
+        return REQUEST_COALESCER.do(key, lambda: _resolve_challenge(req, method), timeout)
+    except TimeoutError:
+        # the follower fails like a request that times out solving the challenge
+        raise Exception(f'Error solving the challenge. Timeout after {timeout} seconds.')
+
+
 def _resolve_challenge(req: V1RequestBase, method: str) -> ChallengeResolutionT:
+    start = time.time()
     timeout = int(req.maxTimeout) / 1000
+    domain = urlparse(req.url).hostname
+    # the timeout can be reduced with the solve times of the domain
+    solve_timeout = SOLVE_TIMES.timeout(domain, timeout)
+    adaptive_timeout = solve_timeout
     driver = None
+    session = None
+    proxy = None
+    circuits = None
+    scheduled = False
+    started = False
+    result = None
+    message = None
     try:
         if req.session:
             session_id = req.session
             ttl = timedelta(minutes=req.session_ttl_minutes) if req.session_ttl_minutes else None
-            session, fresh = SESSIONS_STORAGE.get(session_id, ttl)
+            session, fresh = SESSIONS_STORAGE.get(session_id, ttl, timeout)
 
             if fresh:
                 logging.debug(f"new session created to perform the request (session_id={session_id})")
@@ -241,21 +514,76 @@ def _resolve_challenge(req: V1RequestBase, method: str) -> ChallengeResolutionT:
                 logging.debug(f"existing session is used to perform the request (session_id={session_id}, "
                               f"lifetime={str(session.lifetime())}, ttl={str(ttl)})")
 
-            driver = session.driver
+            circuits = CIRCUIT_BREAKERS.acquire(domain, session.proxy)
+            wait_start = time.time()
+            RATE_LIMITER.acquire(domain, session.proxy, timeout)
+            # concurrent requests in the same session are executed in different tabs, the tab is
+            # acquired first so the requests waiting for a tab don't hold a slot of the scheduler
+            driver = session.tabs.acquire(max(timeout - (time.time() - wait_start), 0.001))
+            scheduled = SCHEDULER.acquire(domain, req.tag, int(req.priority or 0),
+                                          max(timeout - (time.time() - wait_start), 0.001))
+            wait_end = time.time()
         else:
-            driver = utils.get_webdriver(req.proxy)
-            logging.debug('New instance of webdriver has been created to perform the request')
-        return func_timeout(timeout, _evil_logic, (req, driver, method))
+            proxy = PROXY_REGISTRY.select(req.proxy)
+            circuits = CIRCUIT_BREAKERS.acquire(domain, proxy)
+            wait_start = time.time()
+            RATE_LIMITER.acquire(domain, proxy, timeout)
+            scheduled = SCHEDULER.acquire(domain, req.tag, int(req.priority or 0),
+                                          max(timeout - (time.time() - wait_start), 0.001))
+            wait_end = time.time()
+            driver = BROWSER_POOL.lease(proxy)
+        observe_phase('queue', wait_end - wait_start)
+        # the time waiting in the queue or for a free tab counts towards the timeout
+        solve_timeout = max(min(timeout - (wait_end - wait_start), adaptive_timeout), 0.001)
+        solve_start = time.time()
+        started = True
+        # the timings of the request are collected in the thread of func_timeout too
+        result = func_timeout(solve_timeout, contextvars.copy_context().run,
+                              (PROFILER.run, _evil_logic, req, driver, method))
+        SOLVE_TIMES.add(domain, time.time() - solve_start)
+        message = result.message
+        return result
+    except RateLimitException as e:
+        # the client can retry later (retryAfter)
+        message = str(e)
+        raise
     except FunctionTimedOut:
-        raise Exception(f'Error solving the challenge. Timeout after {timeout} seconds.')
+        # the solve time is at least the timeout, without it the adaptive timeout could only go down
+        SOLVE_TIMES.add(domain, time.time() - solve_start)
+        if adaptive_timeout < timeout:
+            message = (f'Error solving the challenge. Timeout after {round(adaptive_timeout, 3)} seconds '
+                       f'(adaptive timeout, the usual solve time of {domain} is much lower).')
+        else:
+            message = f'Error solving the challenge. Timeout after {timeout} seconds.'
+        raise Exception(message)
     except Exception as e:
-        raise Exception('Error solving the challenge. ' + str(e).replace('\n', '\\n'))
+        message = 'Error solving the challenge. ' + str(e).replace('\n', '\\n')
+        raise Exception(message)
     finally:
-        if not req.session and driver is not None:
-            if utils.PLATFORM_VERSION == "nt":
-                driver.close()
-            driver.quit()
-            logging.debug('A used instance of webdriver has been destroyed')
+        # the requests that were not executed don't change the scores of the domain and the proxy
+        result_name = get_result(message if result is not None else f'Error: {message}') if started else None
+        if scheduled:
+            SCHEDULER.release(domain)
+        if circuits is not None:
+            CIRCUIT_BREAKERS.release(circuits, result_name)
+        if session is not None:
+            PROXY_REGISTRY.report(session.proxy, result_name, in_flight=False)
+        else:
+            PROXY_REGISTRY.report(proxy, result_name)
+        if started:
+            # failed or slow requests, the page is read before the browser is cleaned
+            try:
+                FLIGHT_RECORDER.record(req, message, result_name, time.time() - start, driver)
+            except Exception as e:
+                # the tab or the browser must be released anyway
+                logging.warning(f"Flight recorder error. {e}")
+        with phase('teardown'):
+            if session is not None and driver is not None:
+                SESSIONS_STORAGE.clean(session, driver)
+                session.tabs.release(driver)
+            if not req.session and driver is not None:
+                # after a timeout or an error the browser may be in an unknown state
+                BROWSER_POOL.release(driver, proxy, reusable=result is not None)
 
 
 def click_verify(driver: WebDriver, num_tabs: int = 1):
@@ -369,60 +697,66 @@ def _evil_logic(req: V1RequestBase, driver: WebDriver, method: str) -> Challenge
     turnstile_token = None
 
     if method == "POST":
-        _post_request(req, driver)
+        with phase('navigation'):
+            _post_request(req, driver)
     else:
         if req.tabs_till_verify is None:
-            driver.get(req.url)
+            with phase('navigation'):
+                driver.get(req.url)
         else:
-            turnstile_token = _resolve_turnstile_captcha(req, driver)
+            with phase('turnstile'):
+                turnstile_token = _resolve_turnstile_captcha(req, driver)
 
     # set cookies if required
     if req.cookies is not None and len(req.cookies) > 0:
         logging.debug(f'Setting cookies...')
-        for cookie in req.cookies:
-            driver.delete_cookie(cookie['name'])
-            driver.add_cookie(cookie)
-        # reload the page
-        if method == 'POST':
-            _post_request(req, driver)
-        else:
-            driver.get(req.url)
+        with phase('navigation'):
+            for cookie in req.cookies:
+                driver.delete_cookie(cookie['name'])
+                driver.add_cookie(cookie)
+            # reload the page
+            if method == 'POST':
+                _post_request(req, driver)
+            else:
+                driver.get(req.url)
 
     # wait for the page
-    if utils.get_config_log_html():
-        logging.debug(f"Response HTML:\n{driver.page_source}")
-    html_element = driver.find_element(By.TAG_NAME, "html")
-    page_title = driver.title
-
-    # find access denied titles
-    for title in ACCESS_DENIED_TITLES:
-        if page_title.startswith(title):
-            raise Exception('Cloudflare has blocked this request. '
-                            'Probably your IP is banned for this site, check in your web browser.')
-    # find access denied selectors
-    for selector in ACCESS_DENIED_SELECTORS:
-        found_elements = driver.find_elements(By.CSS_SELECTOR, selector)
-        if len(found_elements) > 0:
-            raise Exception('Cloudflare has blocked this request. '
-                            'Probably your IP is banned for this site, check in your web browser.')
-
-    # find challenge by title
-    challenge_found = False
-    for title in CHALLENGE_TITLES:
-        if title.lower() == page_title.lower():
-            challenge_found = True
-            logging.info("Challenge detected. Title found: " + page_title)
-            break
-    if not challenge_found:
-        # find challenge by selectors
-        for selector in CHALLENGE_SELECTORS:
+    if utils.get_config_log_html() and logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Response HTML:\n%s", LogText(driver.page_source))
+    with phase('detection'):
+        html_element = driver.find_element(By.TAG_NAME, "html")
+        page_title = driver.title
+
+        # find access denied titles
+        for title in ACCESS_DENIED_TITLES:
+            if page_title.startswith(title):
+                raise Exception(MESSAGE_BLOCKED + ' Probably your IP is banned for this site, '
+                                                  'check in your web browser.')
+        # find access denied selectors
+        for selector in ACCESS_DENIED_SELECTORS:
             found_elements = driver.find_elements(By.CSS_SELECTOR, selector)
             if len(found_elements) > 0:
+                raise Exception(MESSAGE_BLOCKED + ' Probably your IP is banned for this site, '
+                                                  'check in your web browser.')
+
+        # find challenge by title
+        challenge_found = False
+        for title in CHALLENGE_TITLES:
+            if title.lower() == page_title.lower():
                 challenge_found = True
-                logging.info("Challenge detected. Selector found: " + selector)
+                logging.info("Challenge detected. Title found: " + page_title)
                 break
+        if not challenge_found:
+            # find challenge by selectors
+            for selector in CHALLENGE_SELECTORS:
+                found_elements = driver.find_elements(By.CSS_SELECTOR, selector)
+                if len(found_elements) > 0:
+                    challenge_found = True
+                    logging.info("Challenge detected. Selector found: " + selector)
+                    break
 
     attempt = 0
+    challenge_start = time.perf_counter()
     if challenge_found:
         while True:
             try:
@@ -457,12 +791,15 @@ def _evil_logic(req: V1RequestBase, driver: WebDriver, method: str) -> Challenge
         except Exception:
             logging.debug("Timeout waiting for redirect")
 
-        logging.info("Challenge solved!")
-        res.message = "Challenge solved!"
+        observe_phase('challenge', time.perf_counter() - challenge_start)
+        logging.info(MESSAGE_SOLVED)
+        res.message = MESSAGE_SOLVED
     else:
-        logging.info("Challenge not detected!")
-        res.message = "Challenge not detected!"
+        logging.info(MESSAGE_NOT_DETECTED)
+        res.message = MESSAGE_NOT_DETECTED
 
+    # the time waiting before returning the response (waitInSeconds) is not part of the extraction
+    extraction_start = time.perf_counter()
     challenge_res = ChallengeResolutionResultT({})
     challenge_res.url = driver.current_url
     challenge_res.status = 200  # todo: fix, selenium not provides this info
@@ -476,11 +813,13 @@ def _evil_logic(req: V1RequestBase, driver: WebDriver, method: str) -> Challenge
         if req.waitInSeconds and req.waitInSeconds > 0:
             logging.info("Waiting " + str(req.waitInSeconds) + " seconds before returning the response...")
             time.sleep(req.waitInSeconds)
+            extraction_start += req.waitInSeconds
 
         challenge_res.response = driver.page_source
 
     if req.returnScreenshot:
         challenge_res.screenshot = driver.get_screenshot_as_base64()
+    observe_phase('extraction', time.perf_counter() - extraction_start)
 
     res.result = challenge_res
     return res
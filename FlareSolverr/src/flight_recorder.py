@@ -0,0 +1,146 @@
+import base64
+import itertools
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+from urllib.parse import urlparse
+
+from func_timeout import FunctionTimedOut, func_timeout
+from selenium.webdriver.chrome.webdriver import WebDriver
+
+from dtos import RESULT_NOT_DETECTED, RESULT_SOLVED
+from timings import get_timings
+
+# maximum time to read the page, the browser may be hung after a timeout
+CAPTURE_TIMEOUT = 5
+SCREENSHOT_QUALITY = 30
+
+
+class FlightRecorder:
+    """FlightRecorder saves what happened in the requests that fail or take more than slow_seconds:
+    timings of the phases, WebDriver commands, final URL and title, the beginning of the HTML and
+    optionally a low quality screenshot. The page is read in the request thread (only for these requests),
+    the files are written by a background thread. The oldest recordings are removed when the folder
+    is bigger than max_bytes. The recorder is disabled if enabled is False."""
+
+    def __init__(self, enabled: bool, path: str, slow_seconds: float, max_bytes: int, max_html: int,
+                 screenshot: bool):
+        self.enabled = enabled
+        self.path = path
+        self.slow_seconds = slow_seconds
+        self.max_bytes = max_bytes
+        self.max_html = max_html
+        self.screenshot = screenshot
+        self.ids = itertools.count()
+        # the files are written in order by a single thread
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='flight-recorder')
+
+    def record(self, req, message: Optional[str], result: str, seconds: float, driver: WebDriver):
+        """Records the request if it failed or was slow, result is the result of dtos.get_result"""
+        failed = result not in (RESULT_SOLVED, RESULT_NOT_DETECTED)
+        if not self.enabled or (not failed and seconds < self.slow_seconds):
+            return
+        timings = get_timings()
+        recording = {
+            "id": f"{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{next(self.ids):06d}",
+            "timestamp": int(time.time() * 1000),
+            "url": req.url,
+            "domain": urlparse(req.url).hostname,
+            "session": req.session,
+            "result": result,
+            "message": message,
+            "durationMs": int(seconds * 1000),
+            "timings": timings.to_dict() if timings is not None else None
+        }
+        try:
+            page = func_timeout(CAPTURE_TIMEOUT, self._capture, (driver,))
+        except (FunctionTimedOut, Exception) as e:
+            logging.debug(f"Flight recorder can't read the page. {e}")
+            page = {}
+        recording.update(page)
+        self.executor.submit(self._write, recording)
+
+    def get(self, recording_id: str) -> Optional[dict]:
+        path = self._path(recording_id, '.json')
+        if path is None:
+            return None
+        with open(path, encoding='utf-8') as f:
+            recording = json.load(f)
+        html_path = self._path(recording_id, '.html')
+        if html_path is not None:
+            with open(html_path, encoding='utf-8') as f:
+                recording['html'] = f.read()
+        return recording
+
+    def get_screenshot(self, recording_id: str) -> Optional[str]:
+        """Path of the screenshot, None if it doesn't exist"""
+        return self._path(recording_id, '.jpg')
+
+    def _capture(self, driver: WebDriver) -> dict:
+        page = {"finalUrl": driver.current_url, "title": driver.title, "html": driver.page_source[:self.max_html]}
+        if self.screenshot:
+            page["screenshot"] = driver.execute_cdp_cmd(
+                'Page.captureScreenshot', {'format': 'jpeg', 'quality': SCREENSHOT_QUALITY})['data']
+        return page
+
+    def _write(self, recording: dict):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            html = recording.pop('html', None)
+            screenshot = recording.pop('screenshot', None)
+            recording['screenshot'] = screenshot is not None
+            base = os.path.join(self.path, recording['id'])
+            if html is not None:
+                with open(base + '.html', 'w', encoding='utf-8') as f:
+                    f.write(html)
+            if screenshot is not None:
+                with open(base + '.jpg', 'wb') as f:
+                    f.write(base64.b64decode(screenshot))
+            # the .json file is the last one, the recording is listed when it's complete
+            with open(base + '.json', 'w', encoding='utf-8') as f:
+                json.dump(recording, f)
+            logging.info(f"Flight recorder saved recording {recording['id']} ({recording['result']}, "
+                         f"{recording['durationMs']} ms)")
+            self._purge()
+        except Exception as e:
+            logging.warning(f"Flight recorder error. {e}")
+
+    def _purge(self):
+        # recording id => files, the ids start with the date
+        recordings = {}
+        for name in os.listdir(self.path):
+            recordings.setdefault(os.path.splitext(name)[0], []).append(name)
+        sizes = {name: os.path.getsize(os.path.join(self.path, name)) for names in recordings.values()
+                 for name in names}
+        total = sum(sizes.values())
+        for recording_id in sorted(recordings):
+            if total <= self.max_bytes:
+                break
+            # the .json file first, so the recording is not listed without the rest
+            for name in sorted(recordings[recording_id], key=lambda n: not n.endswith('.json')):
+                os.remove(os.path.join(self.path, name))
+                total -= sizes[name]
+
+    def _names(self, extension: str) -> list[str]:
+        if not os.path.isdir(self.path):
+            return []
+        return [name for name in os.listdir(self.path) if name.endswith(extension)]
+
+    def _path(self, recording_id: str, extension: str) -> Optional[str]:
+        path = os.path.join(self.path, os.path.basename(recording_id) + extension)
+        return path if os.path.isfile(path) else None
+
+    def list(self) -> list[dict]:
+        """The recordings without HTML, the newest first"""
+        recordings = []
+        for name in sorted(self._names('.json'), reverse=True):
+            try:
+                with open(os.path.join(self.path, name), encoding='utf-8') as f:
+                    recordings.append(json.load(f))
+            except (OSError, ValueError):
+                # removed while it was read
+                pass
+        return recordings
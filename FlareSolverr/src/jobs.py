@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
+from uuid import uuid1
+
+import requests
+
+from supervisor import WORKER_ID
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+
+
+class Job:
+    def __init__(self, job_id: str, callback_url: Optional[str] = None):
+        self.job_id = job_id
+        self.status = JOB_PENDING
+        self.result: Optional[dict] = None
+        self.callback_url = callback_url
+        self.finished_at: Optional[float] = None
+        self.event = threading.Event()
+
+
+class JobsStorage:
+    """JobsStorage executes the asynchronous requests in a thread pool and keeps their results
+    for ttl seconds after they finish. The number of jobs stored is limited to max_jobs."""
+
+    def __init__(self, max_workers: int, max_jobs: int, ttl: int):
+        self.max_workers = max_workers
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.executor = None
+        # the callbacks reuse the connections to the clients
+        self.http = requests.Session()
+        self.last_purge = 0.0
+
+    def submit(self, fn: Callable[[], dict], callback_url: Optional[str] = None) -> Job:
+        # the worker id is used by the supervisor to route the job requests in multi-process mode
+        job_id = str(uuid1()) if WORKER_ID is None else f'{WORKER_ID}_{uuid1()}'
+        job = Job(job_id, callback_url)
+        with self.lock:
+            self._purge()
+            if len(self.jobs) >= self.max_jobs:
+                raise Exception(f"Too many jobs in progress, the limit is {self.max_jobs}.")
+            self.jobs[job_id] = job
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+        self.executor.submit(self._run, job, fn)
+        return job
+
+    def get(self, job_id: str, wait: float = 0) -> Optional[Job]:
+        """get returns the job or None if it doesn't exist or has expired.
+        If wait > 0 it waits up to wait seconds until the job is done (long-poll)."""
+        with self.lock:
+            self._purge()
+            job = self.jobs.get(job_id)
+        if job is not None and wait > 0:
+            job.event.wait(wait)
+        return job
+
+    def pending(self) -> int:
+        """Number of jobs not done yet"""
+        with self.lock:
+            return sum(1 for job in self.jobs.values() if job.status != JOB_DONE)
+
+    def _run(self, job: Job, fn: Callable[[], dict]):
+        job.status = JOB_RUNNING
+        try:
+            job.result = fn()
+        except Exception as e:
+            job.result = {"status": "error", "message": "Error: " + str(e)}
+        job.finished_at = time.time()
+        job.status = JOB_DONE
+        job.event.set()
+
+        if job.callback_url:
+            try:
+                self.http.post(job.callback_url, json={"job": job.job_id, "status": job.status,
+                                                       "result": job.result}, timeout=30)
+            except Exception as e:
+                logging.warning(f"Error sending the result of job {job.job_id} to {job.callback_url}. {e}")
+
+    def _purge(self):
+        now = time.time()
+        if now - self.last_purge < 1:
+            return
+        self.last_purge = now
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job.finished_at is not None and now - job.finished_at > self.ttl]
+        for job_id in expired:
+            del self.jobs[job_id]
@@ -0,0 +1,146 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import re
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+import utils
+
+# the digits are ignored to find similar lines (eg: "Waiting for title (attempt 3)")
+DIGITS_RE = re.compile(r'\d+')
+
+
+class LogPayload:
+    """LogPayload is a request or a response in a log line. It's converted to a dict (with the long strings
+    truncated) when the line is written by the log writer thread, so the request thread doesn't pay for it.
+    The fields are copied, the request can change them after it's logged."""
+
+    def __init__(self, obj):
+        # hidden fields are skipped because they may not be serializable
+        self.fields = {k: v for k, v in obj.__dict__.items() if not k.startswith('__')}
+
+    def __str__(self) -> str:
+        return str(_truncate(utils.object_to_dict(self.fields), utils.get_config_log_max_field_length()))
+
+
+class LogText:
+    """LogText is a long string in a log line (eg: the HTML of a page), it's truncated like the fields
+    of LogPayload when the line is written"""
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def __str__(self) -> str:
+        return str(_truncate(self.text, utils.get_config_log_max_field_length()))
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def __init__(self, worker_id: str = None):
+        super().__init__()
+        self.worker_id = worker_id
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            "level": record.levelname,
+            "thread": record.thread,
+            "message": record.getMessage()
+        }
+        if self.worker_id is not None:
+            line["worker"] = self.worker_id
+        if record.exc_text:
+            line["exception"] = record.exc_text
+        return json.dumps(line, default=str)
+
+
+class _LazyQueueHandler(QueueHandler):
+    # the default handler formats the message in the calling thread
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        if record.exc_info:
+            # the traceback keeps the frames of the request alive
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class _Sampler:
+    """Lets through up to max_lines similar lines (same level and formatted message without digits) every window
+    seconds, the number of lines dropped is appended to the next line that gets through"""
+
+    def __init__(self, max_lines: int, window: int):
+        self.max_lines = max_lines
+        self.window = window
+        self.window_start = 0.0
+        # key => [lines in the window, lines dropped]
+        self.counts = {}
+
+    def allow(self, record: logging.LogRecord) -> bool:
+        if self.max_lines <= 0 or record.levelno >= logging.ERROR:
+            return True
+        now = time.time()
+        if now - self.window_start > self.window:
+            self.window_start = now
+            for counts in self.counts.values():
+                counts[0] = 0
+            # the keys without lines dropped are forgotten
+            self.counts = {key: counts for key, counts in self.counts.items() if counts[1] > 0}
+        # the formatted message, the lines with a format string ("... body: %s") are similar only if their
+        # arguments are. It's formatted once, the formatter uses it as is
+        record.msg = record.getMessage()
+        record.args = None
+        key = (record.levelno, DIGITS_RE.sub('#', record.msg))
+        counts = self.counts.setdefault(key, [0, 0])
+        if counts[0] >= self.max_lines:
+            counts[1] += 1
+            return False
+        counts[0] += 1
+        if counts[1] > 0:
+            record.msg = f'{record.msg} ({counts[1]} similar lines dropped)'
+            counts[1] = 0
+        return True
+
+
+class _SamplingQueueListener(QueueListener):
+    def __init__(self, log_queue: queue.Queue, handlers: list, sampler: _Sampler):
+        super().__init__(log_queue, *handlers, respect_handler_level=True)
+        self.sampler = sampler
+
+    def handle(self, record: logging.LogRecord):
+        if self.sampler.allow(record):
+            super().handle(record)
+
+
+def setup(level: str, log_format: str, handlers: list[logging.Handler], worker_id: str = None):
+    """
+    Configures the root logger. The lines are formatted and written by a background thread, so the
+    requests don't wait for the I/O. The pending lines are written at exit.
+    """
+    formatter = JSONFormatter(worker_id) if utils.get_config_log_json() else \
+        logging.Formatter(log_format, datefmt='%Y-%m-%d %H:%M:%S')
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.SimpleQueue()
+    listener = _SamplingQueueListener(log_queue, handlers, _Sampler(utils.get_config_log_sample_max_lines(),
+                                                                     utils.get_config_log_sample_seconds()))
+    listener.start()
+    atexit.register(listener.stop)
+    logging.basicConfig(level=level, handlers=[_LazyQueueHandler(log_queue)], force=True)
+
+
+def _truncate(value, max_length: int):
+    if max_length <= 0:
+        return value
+    if isinstance(value, str) and len(value) > max_length:
+        return f'{value[:max_length]}... ({len(value) - max_length} characters truncated)'
+    if isinstance(value, dict):
+        return {k: _truncate(v, max_length) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_truncate(v, max_length) for v in value]
+    return value
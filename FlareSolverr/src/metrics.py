@@ -1,8 +1,36 @@
+import ipaddress
 import logging
+import os
+import threading
+from contextlib import contextmanager
+from typing import Optional
 
-from prometheus_client import Counter, Histogram, start_http_server
+import psutil
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram, start_http_server
 import time
 
+from dtos import RESULTS
+from timings import get_timings
+
+PROMETHEUS_ENABLED = os.environ.get('PROMETHEUS_ENABLED', 'false').lower() == 'true'
+# seconds between the samples of the memory of the browsers
+BROWSER_SAMPLE_INTERVAL = 15
+# label of the domains that don't have their own series
+OTHER_DOMAIN = 'other'
+# label of the requests without domain
+UNKNOWN_DOMAIN = 'unknown'
+# the folded domains are counted up to this number to bound the memory
+MAX_FOLDED_DOMAINS = 100000
+# the requests of the domains are halved every PROMOTE_INTERVAL requests, a folded domain replaces the
+# labelled domain with fewer requests if it has PROMOTE_FACTOR times its requests
+PROMOTE_INTERVAL = 1000
+PROMOTE_FACTOR = 2
+# second level domains of the country code TLDs (example.co.uk), there is no public suffix list
+SECOND_LEVEL_DOMAINS = {'ac', 'co', 'com', 'edu', 'gob', 'gov', 'ltd', 'me', 'net', 'nic', 'or', 'org', 'plc'}
+# fine buckets, a regression of a few seconds must be visible
+DURATION_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60,
+                    90, 120]
+
 REQUEST_COUNTER = Counter(
     name='flaresolverr_request',
     documentation='Total requests with result',
@@ -12,21 +40,285 @@ REQUEST_DURATION = Histogram(
     name='flaresolverr_request_duration',
     documentation='Request duration in seconds',
     labelnames=['domain'],
-    buckets=[0, 10, 25, 50]
+    buckets=DURATION_BUCKETS
+)
+PHASE_DURATION = Histogram(
+    name='flaresolverr_phase_duration',
+    documentation='Duration of the phases of the requests in seconds (queue, launch, navigation, detection, '
+                  'challenge, turnstile, extraction, serialization and teardown)',
+    labelnames=['phase'],
+    buckets=DURATION_BUCKETS
+)
+
+WEBDRIVER_COMMAND_DURATION = Histogram(
+    name='flaresolverr_webdriver_command_duration',
+    documentation='Duration of the WebDriver commands (roundtrips to chromedriver) in seconds by command',
+    labelnames=['command'],
+    buckets=[0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+)
+METRICS_FOLDED_DOMAINS = Gauge(
+    name='flaresolverr_metrics_folded_domains',
+    documentation=f'Distinct domains exported with the label "{OTHER_DOMAIN}" to bound the number of series',
+    multiprocess_mode='max'
+)
+
+BROWSERS = Gauge(
+    name='flaresolverr_browsers',
+    documentation='Live browsers (sessions, pool and requests in progress)',
+    multiprocess_mode='livesum'
+)
+BROWSER_RSS = Gauge(
+    name='flaresolverr_browser_rss_bytes',
+    documentation='Resident memory of all the Chrome processes',
+    multiprocess_mode='livesum'
+)
+BROWSER_LAUNCHES = Counter(
+    name='flaresolverr_browser_launches',
+    documentation='Total browsers launched by result (ok, error)',
+    labelnames=['result']
+)
+BROWSER_CRASHES = Counter(
+    name='flaresolverr_browser_crashes',
+    documentation='Total browsers found dead when they were closed'
+)
+BROWSER_RECYCLES = Counter(
+    name='flaresolverr_browser_recycles',
+    documentation='Total browsers replaced by a new one by owner (session: SESSION_RECYCLE_* limits, '
+                  'pool: not reusable after the request)',
+    labelnames=['owner']
+)
+SESSIONS = Gauge(
+    name='flaresolverr_sessions',
+    documentation='Live sessions',
+    multiprocess_mode='livesum'
+)
+POOL_BROWSERS = Gauge(
+    name='flaresolverr_pool_browsers',
+    documentation='Browsers of the requests without session by state (idle in the pool, busy)',
+    labelnames=['state'],
+    multiprocess_mode='livesum'
+)
+
+
+SESSION_FREEZE_COUNTER = Counter(
+    name='flaresolverr_session_freeze',
+    documentation='Total idle sessions frozen'
+)
+SESSION_FREEZE_CPU_SAVED = Counter(
+    name='flaresolverr_session_freeze_cpu_saved_seconds',
+    documentation='Estimated browser CPU time saved by freezing idle sessions'
+)
+
+SESSION_HYGIENE_RECLAIMED = Counter(
+    name='flaresolverr_session_hygiene_reclaimed_bytes',
+    documentation='Browser memory reclaimed by the between-request hygiene of the sessions'
+)
+
+REQUEST_COALESCING_COUNTER = Counter(
+    name='flaresolverr_request_coalescing',
+    documentation='Total requests without session by coalescing role (leader executes, follower waits)',
+    labelnames=['role']
+)
+
+PROXY_FORWARDER_BYTES = Counter(
+    name='flaresolverr_proxy_forwarder_bytes',
+    documentation='Bytes forwarded by the local proxy forwarder by upstream proxy and direction',
+    labelnames=['upstream', 'direction']
+)
+PROXY_FORWARDER_CONNECT_DURATION = Histogram(
+    name='flaresolverr_proxy_forwarder_connect_duration',
+    documentation='Time to open a connection through the upstream proxy in seconds',
+    labelnames=['upstream'],
+    buckets=[0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
 )
 
+REAPER_PROCESSES_KILLED = Counter(
+    name='flaresolverr_reaper_processes_killed',
+    documentation='Total orphaned Chrome and chromedriver processes killed by the reaper'
+)
+REAPER_RECLAIMED_BYTES = Counter(
+    name='flaresolverr_reaper_reclaimed_bytes',
+    documentation='Memory and disk reclaimed by the reaper',
+    labelnames=['resource']
+)
+
+
+class DomainLabels:
+    """DomainLabels bounds the number of series of the metrics labelled by domain. If there is an allowlist
+    only those domains have their own label, if not the max_domains domains with more requests (0 is unlimited).
+    The domains are labelled as they are seen and, when there are max_domains, a domain with many requests
+    takes the label of the one with fewer requests (recent requests weigh more, see PROMOTE_INTERVAL). The series
+    of the replaced domain are removed. The rest are exported as OTHER_DOMAIN. With registrable the domains
+    are reduced to the registrable domain (www.example.co.uk => example.co.uk), so the subdomains share the series.
+    In multi-process mode prometheus_client can't remove series, the first max_domains domains seen by each
+    worker keep the label."""
+
+    def __init__(self, max_domains: int, allowlist: list[str], registrable: bool):
+        self.max_domains = max_domains
+        self.registrable = registrable
+        self.allowlist = {self._normalize(domain) for domain in allowlist}
+        self.domains = set()
+        self.folded = set()
+        # requests of the domains (labelled and folded), decayed
+        self.counts = {}
+        self.requests = 0
+        # the workers write the metrics in PROMETHEUS_MULTIPROC_DIR, the domains are not replaced
+        self.promote = 'PROMETHEUS_MULTIPROC_DIR' not in os.environ
+        self.lock = threading.Lock()
+
+    def observe(self, domain: Optional[str], result: str, seconds: float) -> str:
+        """Exports a request to the domain (None if unknown), returns its label. The series are updated
+        holding the lock, so a request labelled just before its domain is replaced doesn't create its series again."""
+        domain = self._normalize(domain) if domain else None
+        with self.lock:
+            label = self._label(domain) if domain else UNKNOWN_DOMAIN
+            REQUEST_DURATION.labels(domain=label).observe(seconds)
+            REQUEST_COUNTER.labels(domain=label, result=result).inc()
+            return label
+
+    def _label(self, domain: str) -> str:
+        if self.allowlist:
+            labelled = domain in self.allowlist
+        elif self.max_domains <= 0:
+            labelled = True
+        else:
+            labelled = self._count(domain)
+        if labelled:
+            return domain
+        if domain not in self.folded and len(self.folded) < MAX_FOLDED_DOMAINS:
+            self.folded.add(domain)
+            METRICS_FOLDED_DOMAINS.set(len(self.folded))
+        return OTHER_DOMAIN
+
+    def _count(self, domain: str) -> bool:
+        """Counts the request, returns True if the domain has its own label"""
+        if domain not in self.domains and len(self.domains) < self.max_domains:
+            self.domains.add(domain)
+        if not self.promote:
+            return domain in self.domains
+        if domain in self.counts or len(self.counts) < MAX_FOLDED_DOMAINS:
+            self.counts[domain] = self.counts.get(domain, 0) + 1
+        self.requests += 1
+        if self.requests % PROMOTE_INTERVAL == 0:
+            self._promote()
+        return domain in self.domains
+
+    def _promote(self):
+        for domain in list(self.counts):
+            self.counts[domain] /= 2
+            # the domains without recent requests are forgotten
+            if self.counts[domain] < 0.5 and domain not in self.domains:
+                del self.counts[domain]
+        folded = sorted((domain for domain in self.counts if domain not in self.domains),
+                        key=self.counts.get, reverse=True)
+        for domain in folded:
+            lightest = min(self.domains, key=lambda d: self.counts.get(d, 0))
+            if self.counts[domain] < PROMOTE_FACTOR * self.counts.get(lightest, 0):
+                break
+            self.domains.remove(lightest)
+            _remove_domain_series(lightest)
+            self.domains.add(domain)
+            self.folded.discard(domain)
+        METRICS_FOLDED_DOMAINS.set(len(self.folded))
+
+    def _normalize(self, domain: str) -> str:
+        domain = domain.lower().rstrip('.')
+        return get_registrable_domain(domain) if self.registrable else domain
+
+
+def _remove_domain_series(domain: str):
+    for result in RESULTS:
+        try:
+            REQUEST_COUNTER.remove(domain, result)
+        except KeyError:
+            pass
+    try:
+        REQUEST_DURATION.remove(domain)
+    except KeyError:
+        pass
+
+
+def get_registrable_domain(domain: str) -> str:
+    try:
+        ipaddress.ip_address(domain)
+        return domain
+    except ValueError:
+        pass
+    labels = domain.split('.')
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_DOMAINS:
+        return '.'.join(labels[-3:])
+    return '.'.join(labels[-2:])
+
+
+def observe_phase(name: str, seconds: float):
+    if PROMETHEUS_ENABLED:
+        PHASE_DURATION.labels(phase=name).observe(seconds)
+    timings = get_timings()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextmanager
+def phase(name: str):
+    """Measures the duration of a phase of the request, nothing is done if the metrics are disabled
+    and the request doesn't return its timings"""
+    if not PROMETHEUS_ENABLED and get_timings() is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_phase(name, time.perf_counter() - start)
+
+
+def sample_browsers(live_dirs: set):
+    """The browsers are started detached (they are not children of FlareSolverr), they are found by their
+    profile folder (live_dirs). Chrome and its children (renderers, gpu...), the chromedrivers are not included.
+    The children carry the profile folder too, each process is counted once."""
+    browser_processes = {}
+    for process in psutil.process_iter(['cmdline']):
+        try:
+            user_data_dir = next((arg.split('=', 1)[1] for arg in process.info['cmdline'] or []
+                                  if arg.startswith('--user-data-dir=')), None)
+            if user_data_dir is None or os.path.normpath(user_data_dir) not in live_dirs:
+                continue
+            for browser_process in [process] + process.children(recursive=True):
+                browser_processes[browser_process.pid] = browser_process
+        except psutil.Error:
+            pass
+    rss = 0
+    for browser_process in browser_processes.values():
+        try:
+            rss += browser_process.memory_info().rss
+        except psutil.Error:
+            pass
+    BROWSER_RSS.set(rss)
+
+
+def start_browser_sampler(get_live_dirs):
+    def run():
+        while True:
+            try:
+                sample_browsers(get_live_dirs())
+            except Exception as e:
+                logging.debug(f"Error sampling the browsers. {e}")
+            time.sleep(BROWSER_SAMPLE_INTERVAL)
+    from threading import Thread
+    Thread(target=run, name='browser-sampler', daemon=True).start()
+
 
-def serve(port):
-    start_http_server(port=port)
+def serve(port, registry=REGISTRY):
+    start_http_server(port=port, registry=registry)
     while True:
         time.sleep(600)
 
 
-def start_metrics_http_server(prometheus_port: int):
+def start_metrics_http_server(prometheus_port: int, registry=REGISTRY):
     logging.info(f"Serving Prometheus exporter on http://0.0.0.0:{prometheus_port}/metrics")
     from threading import Thread
     Thread(
         target=serve,
-        kwargs=dict(port=prometheus_port),
+        kwargs=dict(port=prometheus_port, registry=registry),
         daemon=True,
     ).start()
@@ -0,0 +1,160 @@
+import contextvars
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Optional
+
+# True in the threads of a request selected for profiling
+PROFILED = contextvars.ContextVar('profiled', default=False)
+PROFILE_PREFIX = 'profile_'
+# seconds between samples
+SAMPLE_INTERVAL = 0.01
+# maximum duration of a profile, also when it waits for the next requests
+MAX_SECONDS = 600
+
+
+class Profiler:
+    """Profiler is a sampling profiler started on demand. It takes the stacks of the threads every
+    SAMPLE_INTERVAL seconds, of all the threads during a time window or only of the threads of the next
+    N /v1 requests (the handler thread and the threads started with run()). The profile is written in
+    the collapsed stacks format of flame graphs, one file per profile, the oldest files are removed.
+    Nothing is done while it is not running."""
+
+    def __init__(self, path: str, max_files: int):
+        self.path = path
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.running = False
+        # None: all the threads, if not only the threads of the requests being profiled
+        self.requests = None
+        self.pending_requests = 0
+        self.threads = set()
+        self.stop_event = threading.Event()
+
+    def start(self, seconds: Optional[float] = None, requests: Optional[int] = None) -> dict:
+        if (seconds is None) == (requests is None):
+            raise Exception("The profiler requires 'seconds' or 'requests'.")
+        if requests is not None and requests < 1:
+            raise Exception("The profiler requires 1 or more requests.")
+        if seconds is not None and not 0 < seconds <= MAX_SECONDS:
+            raise Exception(f"The profiler requires between 0 and {MAX_SECONDS} seconds.")
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            if self.running:
+                raise Exception("The profiler is already running.")
+            self.running = True
+            self.requests = requests
+            self.pending_requests = requests or 0
+            self.threads = set()
+            self.stop_event.clear()
+        threading.Thread(target=self._run, args=(seconds or MAX_SECONDS,), name='profiler', daemon=True).start()
+        logging.info(f"Profiler started ({f'{seconds} seconds' if seconds else f'{requests} requests'})")
+        return self.status()
+
+    def status(self) -> dict:
+        with self.lock:
+            running = self.running
+            pending_requests = self.pending_requests
+        files = sorted((name for name in os.listdir(self.path) if name.startswith(PROFILE_PREFIX)), reverse=True) \
+            if os.path.isdir(self.path) else []
+        return {"running": running, "pendingRequests": pending_requests, "profiles": files}
+
+    def get_file(self, name: str) -> Optional[str]:
+        """Path of a profile, None if it doesn't exist"""
+        path = os.path.join(self.path, os.path.basename(name))
+        if not os.path.basename(name).startswith(PROFILE_PREFIX) or not os.path.isfile(path):
+            return None
+        return path
+
+    @contextmanager
+    def request(self):
+        """Profiles the current /v1 request if the profiler is waiting for requests"""
+        if self.pending_requests <= 0:
+            yield
+            return
+        with self.lock:
+            selected = self.running and self.pending_requests > 0
+            if selected:
+                self.pending_requests -= 1
+        if not selected:
+            yield
+            return
+        token = PROFILED.set(True)
+        try:
+            with self._thread():
+                yield
+        finally:
+            PROFILED.reset(token)
+            with self.lock:
+                if self.pending_requests == 0 and not self.threads:
+                    self.stop_event.set()
+
+    def run(self, fn, *args):
+        """Runs fn, the current thread is profiled if it runs a profiled request (context copied)"""
+        if not PROFILED.get():
+            return fn(*args)
+        with self._thread():
+            return fn(*args)
+
+    @contextmanager
+    def _thread(self):
+        ident = threading.get_ident()
+        with self.lock:
+            self.threads.add(ident)
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.threads.discard(ident)
+
+    def _run(self, seconds: float):
+        stacks = Counter()
+        samples = 0
+        deadline = time.time() + seconds
+        try:
+            while time.time() < deadline and not self.stop_event.wait(SAMPLE_INTERVAL):
+                self._sample(stacks)
+                samples += 1
+            self._write(stacks, samples)
+        except Exception as e:
+            logging.error(f"Profiler error. {e}")
+        finally:
+            with self.lock:
+                self.running = False
+                self.pending_requests = 0
+
+    def _sample(self, stacks: Counter):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        with self.lock:
+            threads = None if self.requests is None else set(self.threads)
+        current = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == current or (threads is not None and ident not in threads):
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            # the threads of the same kind are merged (waitress-0, waitress-1...)
+            thread_name = re.sub(r'[-_ ]?\d+', '', names.get(ident, 'unknown'))
+            stacks[';'.join([thread_name] + frames[::-1])] += 1
+
+    def _write(self, stacks: Counter, samples: int):
+        name = f"{PROFILE_PREFIX}{time.strftime('%Y%m%d_%H%M%S')}_{os.getpid()}.txt"
+        with open(os.path.join(self.path, name), 'w', encoding='utf-8') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logging.info(f"Profiler finished, {samples} samples written to {name}")
+
+        profiles = sorted(name for name in os.listdir(self.path) if name.startswith(PROFILE_PREFIX))
+        for old in profiles[:max(len(profiles) - self.max_files, 0)]:
+            try:
+                os.remove(os.path.join(self.path, old))
+            except OSError:
+                pass
@@ -0,0 +1,267 @@
+import asyncio
+import base64
+import ipaddress
+import logging
+import socket
+import struct
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from metrics import PROXY_FORWARDER_BYTES, PROXY_FORWARDER_CONNECT_DURATION
+
+DIRECT = 'direct'
+CONNECT_TIMEOUT = 30
+BUFFER_SIZE = 64 * 1024
+
+
+class Upstream:
+    """Upstream proxy (http, socks4 or socks5) or direct connection when url is None"""
+
+    def __init__(self, proxy: Optional[dict] = None):
+        proxy = proxy or {}
+        self.url = proxy.get('url')
+        self.scheme = None
+        self.host = None
+        self.port = None
+        self.username = proxy.get('username')
+        self.password = proxy.get('password')
+        if self.url:
+            url = urlsplit(self.url if '://' in self.url else 'http://' + self.url)
+            self.scheme = url.scheme.lower()
+            if self.scheme not in ('http', 'socks4', 'socks4a', 'socks5', 'socks5h'):
+                raise Exception(f"Proxy scheme '{self.scheme}' is not supported by the proxy forwarder.")
+            self.host = url.hostname
+            self.port = url.port or (1080 if self.scheme.startswith('socks') else 80)
+            # the credentials can be in the url too
+            self.username = self.username or url.username
+            self.password = self.password or url.password
+
+    @property
+    def name(self) -> str:
+        # metric label, without credentials
+        return DIRECT if self.host is None else f'{self.scheme}://{self.host}:{self.port}'
+
+
+class Route:
+    """Route is a listening port of the forwarder. The browser connects to it and the connections
+    are forwarded to the current upstream of the route, that can be changed between requests."""
+
+    def __init__(self, forwarder: 'ProxyForwarder', upstream: Upstream):
+        self.forwarder = forwarder
+        self.upstream = upstream
+        self.port = None
+        self.server = None
+        self.writers = set()
+
+    @property
+    def proxy_server(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def set_upstream(self, proxy: Optional[dict] = None):
+        upstream = Upstream(proxy)
+        if (upstream.name, upstream.username, upstream.password) == \
+                (self.upstream.name, self.upstream.username, self.upstream.password):
+            return
+        self.upstream = upstream
+        # the browser keeps the connections (and tunnels) alive, they must not be reused with another upstream
+        self.forwarder.call(self._close_connections)
+
+    def close(self):
+        self.forwarder.call(self._close)
+
+    async def _close_connections(self):
+        for writer in list(self.writers):
+            writer.close()
+
+    async def _close(self):
+        self.server.close()
+        await self._close_connections()
+
+
+class ProxyForwarder:
+    """ProxyForwarder is a local HTTP proxy running in its own thread (asyncio). Each browser uses
+    its own route (listening port) and the forwarder connects to the upstream proxy of the route,
+    adding the credentials. This way the proxy of a browser can be changed without launching a new one.
+    The browser sends plain HTTP requests in absolute form and CONNECT requests for HTTPS/WebSockets."""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='proxy-forwarder', daemon=True)
+        self.thread.start()
+
+    def call(self, coro_fn, *args, timeout: float = 30):
+        return asyncio.run_coroutine_threadsafe(coro_fn(*args), self.loop).result(timeout)
+
+    def add_route(self, proxy: Optional[dict] = None) -> Route:
+        route = Route(self, Upstream(proxy))
+        self.call(self._listen, route)
+        logging.debug(f"Proxy forwarder listening on {route.proxy_server} (upstream={route.upstream.name})")
+        return route
+
+    async def _listen(self, route: Route):
+        route.server = await asyncio.start_server(lambda r, w: self._handle(route, r, w), '127.0.0.1', 0)
+        route.port = route.server.sockets[0].getsockname()[1]
+
+    async def _handle(self, route: Route, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        route.writers.add(writer)
+        upstream_writer = None
+        try:
+            # the size of the headers is limited by the buffer of the reader (64 KiB)
+            head = await reader.readuntil(b'\r\n\r\n')
+            request_line, _, headers = head.decode('latin-1').partition('\r\n')
+            method, target, version = request_line.split(' ', 2)
+            upstream = route.upstream
+
+            if method == 'CONNECT':
+                host, port = _split_host_port(target, 443)
+            else:
+                url = urlsplit(target)
+                host, port = url.hostname, url.port or 80
+
+            start = time.time()
+            upstream_reader, upstream_writer = await asyncio.wait_for(
+                self._open(upstream, method, target, host, port), CONNECT_TIMEOUT)
+            PROXY_FORWARDER_CONNECT_DURATION.labels(upstream=upstream.name).observe(time.time() - start)
+
+            if method == 'CONNECT':
+                if upstream.scheme != 'http':
+                    writer.write(b'HTTP/1.1 200 Connection established\r\n\r\n')
+            elif upstream.scheme == 'http':
+                upstream_writer.write(_rewrite_request(method, target, version, headers, upstream, absolute=True))
+            else:
+                upstream_writer.write(_rewrite_request(method, target, version, headers, upstream, absolute=False))
+
+            await asyncio.gather(self._pipe(reader, upstream_writer, upstream.name, 'sent'),
+                                 self._pipe(upstream_reader, writer, upstream.name, 'received'))
+        except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+            pass
+        except Exception as e:
+            logging.debug(f"Proxy forwarder error (upstream={route.upstream.name}). {repr(e)}")
+            try:
+                writer.write(b'HTTP/1.1 502 Bad Gateway\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+            except Exception:
+                pass
+        finally:
+            route.writers.discard(writer)
+            writer.close()
+            if upstream_writer is not None:
+                upstream_writer.close()
+
+    async def _open(self, upstream: Upstream, method: str, target: str, host: str, port: int):
+        if upstream.host is None:
+            return await asyncio.open_connection(host, port)
+
+        reader, writer = await asyncio.open_connection(upstream.host, upstream.port)
+        try:
+            if upstream.scheme == 'http':
+                if method == 'CONNECT':
+                    writer.write(f'CONNECT {target} HTTP/1.1\r\nHost: {target}\r\n'.encode('latin-1') +
+                                 _proxy_authorization(upstream) + b'\r\n')
+                    # the response of the upstream proxy is forwarded to the browser as is
+            elif upstream.scheme.startswith('socks5'):
+                await _socks5_connect(reader, writer, upstream, host, port)
+            else:
+                await _socks4_connect(reader, writer, upstream, host, port)
+        except BaseException:
+            # failed handshake or CONNECT_TIMEOUT (cancelled), the caller doesn't get the connection
+            writer.close()
+            raise
+        return reader, writer
+
+    @staticmethod
+    async def _pipe(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, upstream: str, direction: str):
+        counter = PROXY_FORWARDER_BYTES.labels(upstream=upstream, direction=direction)
+        try:
+            while True:
+                data = await reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                counter.inc(len(data))
+                writer.write(data)
+                await writer.drain()
+        finally:
+            if writer.can_write_eof():
+                try:
+                    writer.write_eof()
+                except OSError:
+                    pass
+
+
+def _split_host_port(target: str, default_port: int) -> tuple:
+    url = urlsplit('//' + target)
+    return url.hostname, url.port or default_port
+
+
+def _proxy_authorization(upstream: Upstream) -> bytes:
+    if not upstream.username:
+        return b''
+    credentials = f'{upstream.username}:{upstream.password or ""}'.encode('utf-8')
+    return b'Proxy-Authorization: Basic ' + base64.b64encode(credentials) + b'\r\n'
+
+
+def _rewrite_request(method: str, target: str, version: str, headers: str, upstream: Upstream,
+                     absolute: bool) -> bytes:
+    if not absolute:
+        url = urlsplit(target)
+        target = (url.path or '/') + ('?' + url.query if url.query else '')
+    lines = [f'{method} {target} {version}']
+    for line in headers.split('\r\n'):
+        name = line.split(':', 1)[0].strip().lower()
+        # one request per connection, the next one may go to another host
+        if line and not name.startswith('proxy-') and name not in ('connection', 'keep-alive'):
+            lines.append(line)
+    lines.append('Connection: close')
+    head = ('\r\n'.join(lines) + '\r\n').encode('latin-1')
+    if absolute:
+        head += _proxy_authorization(upstream)
+    return head + b'\r\n'
+
+
+async def _socks5_connect(reader, writer, upstream: Upstream, host: str, port: int):
+    methods = b'\x00\x02' if upstream.username else b'\x00'
+    writer.write(b'\x05' + bytes([len(methods)]) + methods)
+    version, method = await reader.readexactly(2)
+    if method == 0x02:
+        username = upstream.username.encode('utf-8')
+        password = (upstream.password or '').encode('utf-8')
+        writer.write(b'\x01' + bytes([len(username)]) + username + bytes([len(password)]) + password)
+        _, status = await reader.readexactly(2)
+        if status != 0:
+            raise Exception('SOCKS5 proxy authentication failed')
+    elif method != 0x00:
+        raise Exception('SOCKS5 proxy authentication method not supported')
+
+    try:
+        address = ipaddress.ip_address(host)
+        address_type = b'\x01' if address.version == 4 else b'\x04'
+        writer.write(b'\x05\x01\x00' + address_type + address.packed + struct.pack('>H', port))
+    except ValueError:
+        name = host.encode('idna')
+        writer.write(b'\x05\x01\x00\x03' + bytes([len(name)]) + name + struct.pack('>H', port))
+    _, status, _, address_type = await reader.readexactly(4)
+    if status != 0:
+        raise Exception(f'SOCKS5 proxy connection failed (status={status})')
+    if address_type == 0x01:
+        await reader.readexactly(4 + 2)
+    elif address_type == 0x04:
+        await reader.readexactly(16 + 2)
+    else:
+        length = (await reader.readexactly(1))[0]
+        await reader.readexactly(length + 2)
+
+
+async def _socks4_connect(reader, writer, upstream: Upstream, host: str, port: int):
+    user_id = (upstream.username or '').encode('utf-8') + b'\x00'
+    try:
+        address = socket.inet_aton(host)
+        writer.write(b'\x04\x01' + struct.pack('>H', port) + address + user_id)
+    except OSError:
+        # socks4a, the proxy resolves the host name
+        writer.write(b'\x04\x01' + struct.pack('>H', port) + b'\x00\x00\x00\x01' + user_id +
+                     host.encode('idna') + b'\x00')
+    _, status = struct.unpack('>BB', (await reader.readexactly(8))[:2])
+    if status != 0x5a:
+        raise Exception(f'SOCKS4 proxy connection failed (status={status})')
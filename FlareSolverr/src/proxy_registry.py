@@ -0,0 +1,157 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import requests
+
+import utils
+from dtos import RESULT_BLOCKED, RESULT_ERROR
+
+# weight of the last sample in the moving averages
+EWMA_ALPHA = 0.3
+HEALTH_CHECK_TIMEOUT = 10
+
+
+class ProxyState:
+    def __init__(self, pool: str, proxy: dict):
+        self.pool = pool
+        self.proxy = proxy
+        self.healthy = True
+        # seconds, None until the first health check
+        self.latency: Optional[float] = None
+        # 0 (never fails) .. 1 (always fails)
+        self.failure = 0.0
+        self.consecutive_blocks = 0
+        self.ejected_until = 0.0
+        self.in_flight = 0
+        self.route = None
+
+    @property
+    def url(self) -> str:
+        return self.proxy['url']
+
+    def score(self) -> float:
+        """The lower the better"""
+        latency = self.latency if self.latency is not None else 1.0
+        return latency * (1 + 4 * self.failure) * (1 + self.in_flight)
+
+    def update_failure(self, failed: bool):
+        self.failure = EWMA_ALPHA * (1.0 if failed else 0.0) + (1 - EWMA_ALPHA) * self.failure
+
+
+class ProxyRegistry:
+    """ProxyRegistry keeps named pools of proxies. The requests can use a pool instead of a proxy
+    ("proxy": {"pool": "name"}) and the registry selects the best healthy proxy of the pool:
+    lowest latency (health checks), lowest failure rate and fewest requests in flight.
+    Proxies blocked by the sites several times in a row are ejected for a while."""
+
+    def __init__(self, pools: dict, check_url: str, check_seconds: int, eject_blocks: int, eject_minutes: int):
+        self.pools = {}
+        self.states = {}
+        for pool, proxies in pools.items():
+            self.pools[pool] = []
+            for proxy in proxies:
+                proxy = {"url": proxy} if isinstance(proxy, str) else dict(proxy)
+                state = ProxyState(pool, proxy)
+                self.pools[pool].append(state)
+                self.states[(pool, state.url)] = state
+        self.check_url = check_url
+        self.check_seconds = check_seconds
+        self.eject_blocks = eject_blocks
+        self.eject_seconds = eject_minutes * 60
+        self.lock = threading.Lock()
+        self.health_checks = None
+
+    def select(self, proxy: Optional[dict], in_flight: bool = True) -> Optional[dict]:
+        """Returns the proxy to use for the request. Proxies without pool are returned as they are.
+        If in_flight is True the proxy counts as busy until the result is reported."""
+        if not proxy or 'pool' not in proxy:
+            return proxy
+        pool = proxy['pool']
+        if pool not in self.pools:
+            raise Exception(f"Proxy pool '{pool}' doesn't exist.")
+
+        now = time.time()
+        with self.lock:
+            self._start_health_checks()
+            candidates = [s for s in self.pools[pool] if s.ejected_until <= now]
+            if not candidates:
+                raise Exception(f"All the proxies of the pool '{pool}' have been ejected.")
+            # if all the proxies are down we keep trying with them
+            candidates = [s for s in candidates if s.healthy] or candidates
+            best = min(s.score() for s in candidates)
+            state = random.choice([s for s in candidates if s.score() == best])
+            if in_flight:
+                state.in_flight += 1
+        logging.debug(f"Proxy selected from pool '{pool}': {state.url}")
+        # the pool is kept to report the result
+        return dict(state.proxy, pool=pool)
+
+    def report(self, proxy: Optional[dict], result: Optional[str], in_flight: bool = True):
+        """Updates the scores of the proxy with the result of a request (see dtos.get_result).
+        The result is None if the request was not executed."""
+        state = self._get_state(proxy)
+        if state is None:
+            return
+        with self.lock:
+            if in_flight:
+                state.in_flight = max(state.in_flight - 1, 0)
+            if result is None:
+                return
+            state.update_failure(result in (RESULT_ERROR, RESULT_BLOCKED))
+            if result != RESULT_BLOCKED:
+                state.consecutive_blocks = 0
+                return
+            state.consecutive_blocks += 1
+            if state.consecutive_blocks < self.eject_blocks:
+                return
+            state.consecutive_blocks = 0
+            state.ejected_until = time.time() + self.eject_seconds
+        logging.warning(f"Proxy {state.url} of the pool '{state.pool}' has been blocked "
+                        f"{self.eject_blocks} times in a row, ejected for {self.eject_seconds // 60} minutes")
+
+    def check(self, state: ProxyState):
+        """Health check, a lightweight request to the check url through the proxy"""
+        if state.route is None:
+            # the forwarder supports all the proxy types and credentials
+            state.route = utils.get_proxy_forwarder().add_route(state.proxy)
+        proxies = {"http": state.route.proxy_server, "https": state.route.proxy_server}
+        start = time.time()
+        try:
+            res = requests.get(self.check_url, proxies=proxies, timeout=HEALTH_CHECK_TIMEOUT,
+                               allow_redirects=False)
+            healthy = res.status_code < 500
+        except requests.RequestException as e:
+            logging.debug(f"Proxy {state.url} health check error. {e}")
+            healthy = False
+        latency = time.time() - start
+
+        with self.lock:
+            if healthy != state.healthy:
+                logging.info(f"Proxy {state.url} of the pool '{state.pool}' is "
+                             f"{'healthy' if healthy else 'unhealthy'}")
+            state.healthy = healthy
+            state.update_failure(not healthy)
+            if healthy:
+                state.latency = latency if state.latency is None \
+                    else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * state.latency
+
+    def _get_state(self, proxy: Optional[dict]) -> Optional[ProxyState]:
+        if not proxy or 'pool' not in proxy:
+            return None
+        return self.states.get((proxy['pool'], proxy.get('url')))
+
+    def _start_health_checks(self):
+        if self.health_checks is None and self.check_seconds > 0:
+            self.health_checks = threading.Thread(target=self._health_checks, name='proxy-health-checks',
+                                                  daemon=True)
+            self.health_checks.start()
+
+    def _health_checks(self):
+        with ThreadPoolExecutor(max_workers=8, thread_name_prefix='proxy-health-check') as executor:
+            while True:
+                list(executor.map(self.check, self.states.values()))
+                time.sleep(self.check_seconds)
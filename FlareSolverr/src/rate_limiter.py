@@ -0,0 +1,89 @@
+import math
+import threading
+import time
+from typing import Optional
+
+from dtos import MESSAGE_RATE_LIMITED
+
+MAX_BUCKETS = 10000
+
+
+class RateLimitException(Exception):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        # seconds
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        # tokens per second
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.time()
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self) -> float:
+        """Seconds until there is a token. The tokens can be negative (reserved by waiting requests)."""
+        return max(1 - self.tokens, 0) / self.rate
+
+
+class RateLimiter:
+    """RateLimiter limits the requests per minute to each domain, through each proxy and to each
+    domain through each proxy with token buckets. The limits are disabled with 0.
+    A request takes a token from all its buckets; if they are empty it waits (the token is reserved,
+    so the requests are served in order) or it's rejected if it can't wait so long."""
+
+    def __init__(self, domain_rpm: float, proxy_rpm: float, domain_proxy_rpm: float, burst: int):
+        self.limits = {
+            'domain': domain_rpm / 60,
+            'proxy': proxy_rpm / 60,
+            'domain_proxy': domain_proxy_rpm / 60
+        }
+        self.burst = max(burst, 1)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, domain: Optional[str], proxy: Optional[dict] = None, timeout: float = 0):
+        """Waits until the request can be executed, up to timeout seconds"""
+        proxy_url = proxy.get('url') if proxy else None
+        keys = []
+        if domain and self.limits['domain'] > 0:
+            keys.append(('domain', domain))
+        if proxy_url and self.limits['proxy'] > 0:
+            keys.append(('proxy', proxy_url))
+        if domain and proxy_url and self.limits['domain_proxy'] > 0:
+            keys.append(('domain_proxy', f'{domain} with proxy {proxy_url}'))
+        if not keys:
+            return
+
+        now = time.time()
+        with self.lock:
+            if len(self.buckets) > MAX_BUCKETS:
+                self._purge(now)
+            buckets = []
+            for kind, key in keys:
+                bucket = self.buckets.get((kind, key))
+                if bucket is None:
+                    bucket = self.buckets[(kind, key)] = TokenBucket(self.limits[kind], self.burst)
+                bucket.refill(now)
+                buckets.append(bucket)
+            wait, key = max((bucket.wait_time(), key) for bucket, (_, key) in zip(buckets, keys))
+            if wait > timeout:
+                raise RateLimitException(f"{MESSAGE_RATE_LIMITED} for {key}. Retry in {math.ceil(wait)} seconds.",
+                                         wait)
+            for bucket in buckets:
+                bucket.tokens -= 1
+        if wait > 0:
+            time.sleep(wait)
+
+    def _purge(self, now: float):
+        # the full buckets are the same as new ones
+        for key, bucket in list(self.buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.buckets[key]
@@ -0,0 +1,137 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import psutil
+
+import undetected_chromedriver as uc
+import utils
+from metrics import REAPER_PROCESSES_KILLED, REAPER_RECLAIMED_BYTES
+
+# folders of the chromedriver executables of FlareSolverr (Docker image and patched by undetected_chromedriver)
+DRIVER_DIRS = {os.path.normpath('/app'), os.path.normpath(uc.Patcher.data_path)}
+
+
+class Reaper:
+    """Reaper kills the Chrome and chromedriver processes and removes the temporary folders
+    (browser profiles, that include the proxy extensions) that are not used by a live browser. They are left behind
+    when FlareSolverr is killed or when a browser is not closed properly (eg: timeout launching it).
+    The profiles of the browsers contain the pid of the FlareSolverr process that owns them, so
+    several FlareSolverr processes (workers) can share the same machine."""
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.thread = None
+
+    def start(self):
+        self.reap()
+        if self.interval > 0 and self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='reaper', daemon=True)
+            self.thread.start()
+
+    def reap(self) -> tuple[int, int, int]:
+        """Returns the number of processes killed, the memory and the disk reclaimed in bytes"""
+        live_dirs = utils.get_live_dirs()
+        processes = self._find_processes(live_dirs)
+        memory = 0
+        for process in processes:
+            try:
+                memory += process.memory_info().rss
+                process.kill()
+            except psutil.Error:
+                pass
+        psutil.wait_procs(processes, timeout=5)
+
+        disk = 0
+        for path in self._find_dirs(live_dirs):
+            disk += _get_dir_size(path)
+            shutil.rmtree(path, ignore_errors=True)
+
+        if processes or disk:
+            REAPER_PROCESSES_KILLED.inc(len(processes))
+            REAPER_RECLAIMED_BYTES.labels(resource='memory').inc(memory)
+            REAPER_RECLAIMED_BYTES.labels(resource='disk').inc(disk)
+            logging.info(f"Reaper killed {len(processes)} orphaned browser processes and removed unused "
+                         f"temporary folders, reclaimed memory: {memory // 2 ** 20} MB, "
+                         f"disk: {disk // 2 ** 20} MB")
+        return len(processes), memory, disk
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception as e:
+                logging.warning(f"Reaper error. {e}")
+
+    @staticmethod
+    def _find_processes(live_dirs: set) -> list:
+        processes = []
+        for process in psutil.process_iter(['name', 'exe', 'cmdline', 'ppid']):
+            try:
+                cmdline = process.info['cmdline'] or []
+                name = (process.info['name'] or '').lower()
+                user_data_dir = next((arg.split('=', 1)[1] for arg in cmdline
+                                      if arg.startswith('--user-data-dir=')), None)
+                if user_data_dir is not None:
+                    # chrome, the children (renderers, gpu...) are killed with it
+                    if _is_orphaned_dir(os.path.normpath(user_data_dir), live_dirs):
+                        processes += [process] + process.children(recursive=True)
+                elif 'chromedriver' in name and process.info['ppid'] == 1 and os.getpid() != 1 \
+                        and _is_flaresolverr_driver(process.info['exe'] or (cmdline or [''])[0]):
+                    # the chromedriver is a child of FlareSolverr, it's adopted by init when FlareSolverr dies.
+                    # the chromedrivers of other programs on the host are not touched
+                    processes.append(process)
+            except psutil.Error:
+                pass
+        return list({process.pid: process for process in processes}.values())
+
+    @staticmethod
+    def _find_dirs(live_dirs: set) -> list[str]:
+        paths = []
+        tmp_dir = tempfile.gettempdir()
+        for name in os.listdir(tmp_dir):
+            path = os.path.normpath(os.path.join(tmp_dir, name))
+            if _is_orphaned_dir(path, live_dirs):
+                paths.append(path)
+        return paths
+
+
+def _is_orphaned_dir(path: str, live_dirs: set) -> bool:
+    """The profile folders are named PROFILE_DIR_PREFIX + owner pid + random"""
+    name = os.path.basename(path)
+    if not name.startswith(utils.PROFILE_DIR_PREFIX):
+        return False
+    owner_pid = name[len(utils.PROFILE_DIR_PREFIX):].split('_', 1)[0]
+    if not owner_pid.isdigit():
+        return False
+    if int(owner_pid) == os.getpid():
+        # the recent folders may belong to browsers that are starting
+        return path not in live_dirs and _get_age(path) > 60
+    return not psutil.pid_exists(int(owner_pid))
+
+
+def _is_flaresolverr_driver(exe: str) -> bool:
+    # the patched executables may be removed while they run (' (deleted)'), the folder is checked
+    return bool(exe) and os.path.dirname(os.path.normpath(exe)) in DRIVER_DIRS
+
+
+def _get_age(path: str) -> float:
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return float('inf')
+
+
+def _get_dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.lstat(os.path.join(root, file)).st_size
+            except OSError:
+                pass
+    return size
@@ -0,0 +1,109 @@
+import itertools
+import threading
+import time
+from typing import Optional
+
+# domain used for the requests without url
+UNKNOWN_DOMAIN = ''
+
+
+class _Waiter:
+    def __init__(self, domain: str, priority: int, start: float, finish: float, seq: int):
+        self.domain = domain
+        self.priority = priority
+        # virtual start and finish time of the request in its flow (fair queueing)
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+
+    def key(self) -> tuple:
+        return -self.priority, self.finish, self.seq
+
+
+class Scheduler:
+    """Scheduler limits the number of challenges solved at the same time (max_concurrency) and per
+    domain (domain_limits). When there are no free slots the requests wait in a queue ordered by
+    priority (higher first) and, with the same priority, by fair queueing between flows (the client
+    tag or the domain of the request), so a flow with many requests doesn't starve the rest.
+    A flow with weight N gets N times the slots of a flow with weight 1 (weighted fair queueing).
+    The scheduler is disabled when there are no limits."""
+
+    def __init__(self, max_concurrency: int, domain_limits: dict, weights: Optional[dict] = None):
+        self.max_concurrency = max_concurrency
+        # '*' is the default limit of the domains
+        self.domain_limits = domain_limits
+        # '*' is the default weight of the flows
+        self.weights = weights or {}
+        self.running = 0
+        self.running_domains = {}
+        self.waiters = []
+        # virtual time and last finish time of each flow
+        self.virtual_time = 0.0
+        self.flows = {}
+        self.seq = itertools.count()
+        self.condition = threading.Condition()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_concurrency > 0 or any(limit > 0 for limit in self.domain_limits.values())
+
+    def acquire(self, domain: Optional[str], flow: Optional[str] = None, priority: int = 0,
+                timeout: float = None) -> bool:
+        """Waits for a free slot for the domain, up to timeout seconds.
+        Returns False if the scheduler is disabled (release() is not needed)."""
+        if not self.enabled:
+            return False
+        domain = domain or UNKNOWN_DOMAIN
+        flow = flow or domain
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.condition:
+            start = max(self.virtual_time, self.flows.get(flow, 0.0))
+            finish = start + 1 / self._weight(flow)
+            self.flows[flow] = finish
+            waiter = _Waiter(domain, priority, start, finish, next(self.seq))
+            self.waiters.append(waiter)
+            try:
+                while self._next() is not waiter:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise Exception(f'Timeout waiting for a free slot to solve the challenge '
+                                        f'({self.running} challenges in progress).')
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters.remove(waiter)
+                # the next waiter may be eligible now
+                self.condition.notify_all()
+
+            self.virtual_time = max(self.virtual_time, waiter.start)
+            self.running += 1
+            self.running_domains[domain] = self.running_domains.get(domain, 0) + 1
+            if len(self.flows) > 10000:
+                # the flows behind the virtual time don't have advantage, they can be forgotten
+                self.flows = {k: v for k, v in self.flows.items() if v > self.virtual_time}
+            return True
+
+    def release(self, domain: Optional[str]):
+        domain = domain or UNKNOWN_DOMAIN
+        with self.condition:
+            self.running -= 1
+            self.running_domains[domain] -= 1
+            if self.running_domains[domain] == 0:
+                del self.running_domains[domain]
+            self.condition.notify_all()
+
+    def _weight(self, flow: str) -> float:
+        weight = self.weights.get(flow, self.weights.get('*', 1))
+        return weight if weight > 0 else 1
+
+    def _domain_limit(self, domain: str) -> int:
+        return self.domain_limits.get(domain, self.domain_limits.get('*', 0))
+
+    def _next(self) -> Optional[_Waiter]:
+        """The first waiter that can run now"""
+        if 0 < self.max_concurrency <= self.running:
+            return None
+        eligible = [w for w in self.waiters
+                    if self._domain_limit(w.domain) <= 0
+                    or self.running_domains.get(w.domain, 0) < self._domain_limit(w.domain)]
+        return min(eligible, key=_Waiter.key, default=None)
@@ -1,5 +1,10 @@
 import logging
-from dataclasses import dataclass
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from typing import Optional, Tuple
 from uuid import uuid1
@@ -7,6 +12,119 @@ from uuid import uuid1
 from selenium.webdriver.chrome.webdriver import WebDriver
 
 import utils
+from metrics import (BROWSER_RECYCLES, SESSION_FREEZE_COUNTER, SESSION_FREEZE_CPU_SAVED, SESSION_HYGIENE_RECLAIMED,
+                     SESSIONS)
+
+# fields accepted by the CDP Network.setCookies command (Network.CookieParam)
+COOKIE_PARAM_FIELDS = ['name', 'value', 'domain', 'path', 'secure', 'httpOnly', 'sameSite', 'expires',
+                       'priority', 'sameParty', 'sourceScheme', 'sourcePort', 'partitionKey']
+# maximum time waiting for the tabs of a session to be free (freeze, resume, recycle)
+EXCLUSIVE_TIMEOUT = 300
+
+
+class TabPool:
+    """TabPool dispatches the requests of a session to up to max_tabs tabs of the same browser.
+    The first tab is the session driver, the rest are opened on demand and share its cookies.
+    Requests that don't find a free tab wait in FIFO order."""
+
+    def __init__(self, driver: WebDriver, max_tabs: int):
+        self.driver = driver
+        self.max_tabs = max_tabs
+        self.tabs = [driver]
+        self.idle = [driver]
+        # CDP target id of each tab, the windows not in this list are closed by the session hygiene
+        self.target_ids = {}
+        # tabs opened plus tabs being opened
+        self.opened = 1
+        self.waiters = deque()
+        self.condition = threading.Condition()
+
+    def busy(self) -> int:
+        return self.opened - len(self.idle)
+
+    def acquire(self, timeout: Optional[float] = None) -> WebDriver:
+        ticket = object()
+        with self.condition:
+            self.waiters.append(ticket)
+            try:
+                if not self.condition.wait_for(
+                        lambda: self.waiters[0] is ticket and (self.idle or self.opened < self.max_tabs), timeout):
+                    raise Exception(f'Timeout after {timeout} seconds waiting for a free tab in the session.')
+                if self.idle:
+                    return self.idle.pop()
+                self.opened += 1
+            finally:
+                self.waiters.remove(ticket)
+                self.condition.notify_all()
+
+        tab = None
+        try:
+            tab = utils.get_webdriver_tab(self.driver)
+            target_id = _get_target_id(tab)
+        except Exception:
+            if tab is not None:
+                utils.close_webdriver_tab(tab)
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify_all()
+            raise
+        with self.condition:
+            self.tabs.append(tab)
+            self.target_ids[tab] = target_id
+        return tab
+
+    def get_target_ids(self) -> Optional[list[str]]:
+        """Returns the CDP target ids of the tabs, or None if a tab is being opened."""
+        with self.condition:
+            if self.opened > len(self.tabs):
+                return None
+            if self.driver not in self.target_ids:
+                self.target_ids[self.driver] = _get_target_id(self.driver)
+            return list(self.target_ids.values())
+
+    def release(self, tab: WebDriver):
+        with self.condition:
+            if tab in self.tabs:
+                self.idle.append(tab)
+            self.condition.notify_all()
+
+    @contextmanager
+    def exclusive(self, timeout: float = EXCLUSIVE_TIMEOUT):
+        """exclusive waits until all the tabs are free and blocks new requests
+        until the context manager exits. It raises an exception after timeout seconds."""
+        ticket = object()
+        with self.condition:
+            self.waiters.append(ticket)
+            if not self.condition.wait_for(lambda: self.waiters[0] is ticket and self.busy() == 0, timeout):
+                self.waiters.remove(ticket)
+                self.condition.notify_all()
+                raise Exception(f'Timeout after {timeout} seconds waiting for the tabs of the session to be free.')
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.waiters.remove(ticket)
+                self.condition.notify_all()
+
+    def reset(self, driver: WebDriver):
+        """reset closes the extra tabs and starts again with a new session driver.
+        It must be called inside exclusive()."""
+        self.close_tabs()
+        self.driver = driver
+        self.tabs = [driver]
+        self.idle = [driver]
+        self.target_ids = {}
+        self.opened = 1
+
+    def close_tabs(self):
+        for tab in self.tabs[1:]:
+            try:
+                utils.close_webdriver_tab(tab)
+            except Exception as e:
+                logging.debug(f'Error closing the session tab. {e}')
+        self.tabs = self.tabs[:1]
+        self.idle = [tab for tab in self.idle if tab in self.tabs]
+        self.target_ids = {tab: target_id for tab, target_id in self.target_ids.items() if tab in self.tabs}
 
 
 @dataclass
@@ -14,16 +132,39 @@ class Session:
     session_id: str
     driver: WebDriver
     created_at: datetime
+    proxy: Optional[dict] = None
+    # number of requests served by the current browser instance
+    requests: int = 0
+    browser_created_at: datetime = field(default_factory=datetime.now)
+    tabs: TabPool = None
+    last_used_at: datetime = field(default_factory=datetime.now)
+    # idle sessions are frozen to stop the page timers, see SessionsStorage.freeze_idle_sessions()
+    frozen_at: Optional[datetime] = None
+    # (timestamp, browser CPU time) samples used to estimate the CPU saved while frozen
+    cpu_sample: Optional[Tuple[float, float]] = None
+    idle_cpu_rate: float = 0.0
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def __post_init__(self):
+        if self.tabs is None:
+            self.tabs = TabPool(self.driver, utils.get_config_session_max_tabs())
 
     def lifetime(self) -> timedelta:
         return datetime.now() - self.created_at
 
+    def browser_lifetime(self) -> timedelta:
+        return datetime.now() - self.browser_created_at
+
 
 class SessionsStorage:
     """SessionsStorage creates, stores and process all the sessions"""
 
     def __init__(self):
         self.sessions = {}
+        # sessions whose browser is being launched, the concurrent requests of the same session wait for it
+        self.creating = {}
+        self.lock = threading.Lock()
+        self.housekeeping_thread = None
 
     def create(self, session_id: Optional[str] = None, proxy: Optional[dict] = None,
                force_new: Optional[bool] = False) -> Tuple[Session, bool]:
@@ -42,14 +183,30 @@ class SessionsStorage:
         if force_new:
             self.destroy(session_id)
 
-        if self.exists(session_id):
-            return self.sessions[session_id], False
+        while True:
+            with self.lock:
+                session = self.sessions.get(session_id)
+                if session is not None:
+                    return session, False
+                creating = self.creating.get(session_id)
+                if creating is None:
+                    creating = self.creating[session_id] = threading.Event()
+                    break
+            # if the launch fails the next waiter tries again
+            creating.wait()
 
-        driver = utils.get_webdriver(proxy)
-        created_at = datetime.now()
-        session = Session(session_id, driver, created_at)
-
-        self.sessions[session_id] = session
+        try:
+            driver = utils.get_webdriver(proxy)
+            created_at = datetime.now()
+            session = Session(session_id, driver, created_at, proxy)
+            with self.lock:
+                self.sessions[session_id] = session
+            SESSIONS.inc()
+        finally:
+            with self.lock:
+                del self.creating[session_id]
+            creating.set()
+        self._start_housekeeping()
 
         return session, True
 
@@ -62,23 +219,343 @@ class SessionsStorage:
         The function returns True if session was found and destroyed,
         and False if session_id wasn't found.
         """
-        if not self.exists(session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+        if session is None:
             return False
 
-        session = self.sessions.pop(session_id)
-        if utils.PLATFORM_VERSION == "nt":
-            session.driver.close()
-        session.driver.quit()
+        SESSIONS.dec()
+        session.tabs.close_tabs()
+        utils.quit_webdriver(session.driver)
         return True
 
-    def get(self, session_id: str, ttl: Optional[timedelta] = None) -> Tuple[Session, bool]:
+    def get(self, session_id: str, ttl: Optional[timedelta] = None,
+            timeout: float = EXCLUSIVE_TIMEOUT) -> Tuple[Session, bool]:
         session, fresh = self.create(session_id)
 
-        if ttl is not None and not fresh and session.lifetime() > ttl:
-            logging.debug(f'session\'s lifetime has expired, so the session is recreated (session_id={session_id})')
-            session, fresh = self.create(session_id, force_new=True)
+        self._wake(session, timeout)
+
+        if not fresh and (_expired(session, ttl) or self._recycle_reason(session) is not None):
+            # the browser can't be replaced while other requests are using its tabs,
+            # the concurrent requests check again after waiting for them
+            with session.tabs.exclusive(timeout):
+                if _expired(session, ttl):
+                    logging.debug(f'session\'s lifetime has expired, so the session is recreated '
+                                  f'(session_id={session_id})')
+                    # a new browser without the state of the old one, the proxy is kept
+                    if self.recycle(session, keep_cookies=False):
+                        session.created_at = datetime.now()
+                        fresh = True
+                else:
+                    reason = self._recycle_reason(session)
+                    if reason is not None:
+                        logging.info(f'Recycling the browser of session {session_id} ({reason})')
+                        self.recycle(session)
 
+        session.requests += 1
         return session, fresh
 
+    def recycle(self, session: Session, keep_cookies: bool = True) -> bool:
+        """recycle relaunches the browser of the session behind the same session_id.
+        The cookies of the old browser are copied into the new one (unless keep_cookies is False)
+        before the old one is closed, the User-Agent is kept because all the browsers are launched
+        with the same one. If the new browser can't be launched the old one is kept and it returns False.
+        The tabs of the session must not be in use.
+        """
+        cookies = _get_all_cookies(session.driver) if keep_cookies else []
+        try:
+            driver = utils.get_webdriver(session.proxy)
+        except Exception as e:
+            logging.warning(f'Error recycling the browser of session {session.session_id}, '
+                            f'the old browser is kept. {e}')
+            return False
+        if cookies:
+            _set_all_cookies(driver, cookies)
+        old_driver = session.driver
+        session.tabs.reset(driver)
+        utils.quit_webdriver(old_driver)
+        BROWSER_RECYCLES.labels(owner='session').inc()
+
+        session.driver = driver
+        session.requests = 0
+        session.browser_created_at = datetime.now()
+        return True
+
+    def fork(self, session_id: str, count: int, timeout: Optional[float] = None) -> list[Session]:
+        """fork creates count new sessions with a copy of the state of an existing session:
+        cookies, local storage of the current page and proxy. The browsers are launched
+        in parallel, the cookies are injected before the first navigation and the local storage
+        from a page of its origin. If any of them fails, none of the sessions is created.
+        """
+        source = self.sessions.get(session_id)
+        if source is None:
+            raise Exception("The session doesn't exist.")
+
+        self._wake(source, timeout)
+        tab = source.tabs.acquire(timeout)
+        try:
+            cookies = _get_all_cookies(tab)
+            origin, local_storage = _get_local_storage(tab)
+        finally:
+            source.tabs.release(tab)
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            futures = [executor.submit(_launch_fork, source.proxy, cookies, origin, local_storage)
+                       for _ in range(count)]
+        drivers = [future.result() for future in futures if future.exception() is None]
+        if len(drivers) < count:
+            for driver in drivers:
+                utils.quit_webdriver(driver)
+            raise next(future.exception() for future in futures if future.exception() is not None)
+
+        sessions = []
+        for driver in drivers:
+            session = Session(str(uuid1()), driver, datetime.now(), source.proxy)
+            with self.lock:
+                self.sessions[session.session_id] = session
+            SESSIONS.inc()
+            sessions.append(session)
+        self._start_housekeeping()
+        return sessions
+
+    def freeze_idle_sessions(self, idle_seconds: int):
+        """freeze_idle_sessions freezes the pages of the sessions that have not been used
+        in the last idle_seconds, so the JavaScript timers, websockets and ads of the
+        target site stop consuming CPU. The sessions are resumed in the next request.
+        """
+        for session in list(self.sessions.values()):
+            now = time.time()
+            cpu_time = utils.get_webdriver_cpu_time(session.driver)
+            with session.lock:
+                if session.frozen_at is not None:
+                    continue
+                if session.tabs.busy() > 0:
+                    session.cpu_sample = None
+                    continue
+                if session.cpu_sample is not None and now > session.cpu_sample[0]:
+                    session.idle_cpu_rate = (cpu_time - session.cpu_sample[1]) / (now - session.cpu_sample[0])
+                session.cpu_sample = (now, cpu_time)
+                if datetime.now() - session.last_used_at < timedelta(seconds=idle_seconds):
+                    continue
+                # once marked, the next request waits until the session is frozen and resumes it
+                session.frozen_at = datetime.now()
+            try:
+                with session.tabs.exclusive():
+                    with session.lock:
+                        # a request may have resumed the session while it waited for the tabs
+                        frozen = session.frozen_at is not None
+                    if frozen:
+                        self._freeze(session)
+            except Exception:
+                with session.lock:
+                    session.frozen_at = None
+                raise
+
+    @staticmethod
+    def clean(session: Session, tab: WebDriver):
+        """clean runs the between-request hygiene configured in SESSION_HYGIENE on a tab
+        that has just been used. The available options are:
+        - windows: close the windows and popups opened by the target sites
+        - gc: run the JavaScript garbage collector
+        - cache: clear the HTTP cache of the browser
+        - service_workers: unregister the service workers of the current site
+        """
+        hygiene = utils.get_config_session_hygiene()
+        if len(hygiene) == 0:
+            return
+
+        rss_before = utils.get_webdriver_rss(session.driver)
+        if 'windows' in hygiene:
+            try:
+                target_ids = session.tabs.get_target_ids()
+                targets = tab.execute_cdp_cmd("Target.getTargets", {})['targetInfos'] if target_ids else []
+                for target in targets:
+                    if target['type'] == 'page' and target['targetId'] not in target_ids:
+                        logging.debug(f"Closing stray window: {target['url']}")
+                        tab.execute_cdp_cmd("Target.closeTarget", {"targetId": target['targetId']})
+            except Exception as e:
+                logging.debug(f'Error closing the stray windows. {e}')
+        if 'service_workers' in hygiene:
+            try:
+                origin = tab.execute_script("return window.location.origin")
+                if origin and origin != 'null':
+                    tab.execute_cdp_cmd("Storage.clearDataForOrigin",
+                                        {"origin": origin, "storageTypes": "service_workers"})
+            except Exception as e:
+                logging.debug(f'Error clearing the service workers. {e}')
+        if 'cache' in hygiene:
+            try:
+                tab.execute_cdp_cmd("Network.clearBrowserCache", {})
+            except Exception as e:
+                logging.debug(f'Error clearing the browser cache. {e}')
+        if 'gc' in hygiene:
+            try:
+                tab.execute_cdp_cmd("HeapProfiler.collectGarbage", {})
+            except Exception as e:
+                logging.debug(f'Error running the garbage collector. {e}')
+
+        reclaimed = max(rss_before - utils.get_webdriver_rss(session.driver), 0)
+        SESSION_HYGIENE_RECLAIMED.inc(reclaimed)
+        logging.debug(f'Session {session.session_id} hygiene ({",".join(hygiene)}) '
+                      f'reclaimed {reclaimed / 1024 / 1024:.1f} MB')
+
     def session_ids(self) -> list[str]:
         return list(self.sessions.keys())
+
+    def _start_housekeeping(self):
+        idle_seconds = utils.get_config_session_freeze_idle_seconds()
+        if idle_seconds <= 0 or self.housekeeping_thread is not None:
+            return
+        self.housekeeping_thread = threading.Thread(
+            target=self._housekeeping,
+            args=(idle_seconds,),
+            name='sessions-housekeeping',
+            daemon=True,
+        )
+        self.housekeeping_thread.start()
+
+    def _housekeeping(self, idle_seconds: int):
+        interval = max(1.0, min(idle_seconds / 4, 30.0))
+        while True:
+            time.sleep(interval)
+            try:
+                self.freeze_idle_sessions(idle_seconds)
+            except Exception as e:
+                logging.warning(f'Error freezing idle sessions. {e}')
+
+    @staticmethod
+    def _freeze(session: Session):
+        for tab in session.tabs.tabs:
+            try:
+                tab.execute_cdp_cmd("Page.setWebLifecycleState", {"state": "frozen"})
+            except Exception as e:
+                # the next request navigates to its own url, so it's not necessary to save the current one
+                logging.debug(f'Page.setWebLifecycleState failed, navigating to about:blank. {e}')
+                try:
+                    tab.get('about:blank')
+                except Exception as e:
+                    logging.debug(f'Error freezing the session tab. {e}')
+        session.cpu_sample = (time.time(), utils.get_webdriver_cpu_time(session.driver))
+        SESSION_FREEZE_COUNTER.inc()
+        logging.debug(f'Session {session.session_id} frozen after {str(datetime.now() - session.last_used_at)} idle')
+
+    @staticmethod
+    def _wake(session: Session, timeout: float = EXCLUSIVE_TIMEOUT):
+        """_wake marks the session as used and resumes it if it's frozen."""
+        with session.lock:
+            session.last_used_at = datetime.now()
+            if session.frozen_at is None:
+                # the CPU consumed by the request is not idle CPU
+                session.cpu_sample = None
+                session.idle_cpu_rate = 0.0
+                return
+        with session.tabs.exclusive(timeout):
+            if session.frozen_at is None:
+                return
+            for tab in session.tabs.tabs:
+                try:
+                    tab.execute_cdp_cmd("Page.setWebLifecycleState", {"state": "active"})
+                except Exception as e:
+                    logging.debug(f'Error resuming the session tab. {e}')
+
+            frozen_seconds = (datetime.now() - session.frozen_at).total_seconds()
+            cpu_saved = 0.0
+            if session.cpu_sample is not None:
+                frozen_cpu_time = utils.get_webdriver_cpu_time(session.driver) - session.cpu_sample[1]
+                cpu_saved = max(session.idle_cpu_rate * frozen_seconds - frozen_cpu_time, 0.0)
+            SESSION_FREEZE_CPU_SAVED.inc(cpu_saved)
+            logging.info(f'Session {session.session_id} resumed after {frozen_seconds:.0f} s frozen, '
+                         f'{cpu_saved:.1f} s of CPU saved')
+            with session.lock:
+                session.frozen_at = None
+                session.cpu_sample = None
+
+    @staticmethod
+    def _recycle_reason(session: Session) -> Optional[str]:
+        max_requests = utils.get_config_session_recycle_requests()
+        if 0 < max_requests <= session.requests:
+            return f'{session.requests} requests served'
+
+        max_minutes = utils.get_config_session_recycle_minutes()
+        if max_minutes > 0 and session.browser_lifetime() > timedelta(minutes=max_minutes):
+            return f'browser lifetime {str(session.browser_lifetime())}'
+
+        max_rss_mb = utils.get_config_session_recycle_rss_mb()
+        if max_rss_mb > 0:
+            rss_mb = utils.get_webdriver_rss(session.driver) / 1024 / 1024
+            if rss_mb > max_rss_mb:
+                return f'browser memory {rss_mb:.0f} MB'
+
+        return None
+
+
+def _expired(session: Session, ttl: Optional[timedelta]) -> bool:
+    return ttl is not None and session.lifetime() > ttl
+
+
+def _get_target_id(driver: WebDriver) -> str:
+    # the CDP commands of a driver are sent to the page of its window
+    return driver.execute_cdp_cmd("Target.getTargetInfo", {})['targetInfo']['targetId']
+
+
+def _get_all_cookies(driver: WebDriver) -> list:
+    # driver.get_cookies() only returns the cookies of the current domain
+    try:
+        return driver.execute_cdp_cmd("Network.getAllCookies", {})['cookies']
+    except Exception as e:
+        logging.debug(f'Network.getAllCookies failed, falling back to the current domain cookies. {e}')
+        cookies = []
+        for cookie in driver.get_cookies():
+            cookie = dict(cookie)
+            if 'expiry' in cookie:
+                cookie['expires'] = cookie.pop('expiry')
+            cookies.append(cookie)
+        return cookies
+
+
+def _set_all_cookies(driver: WebDriver, cookies: list):
+    # Network.setCookies works before the first navigation and for any domain
+    params = []
+    for cookie in cookies:
+        param = {k: v for k, v in cookie.items() if k in COOKIE_PARAM_FIELDS}
+        if cookie.get('session') or param.get('expires', -1) < 0:
+            param.pop('expires', None)
+        params.append(param)
+    if len(params) == 0:
+        return
+    try:
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": params})
+    except Exception as e:
+        logging.warning(f'Error restoring the session cookies. {e}')
+
+
+def _get_local_storage(driver: WebDriver) -> Tuple[Optional[str], list]:
+    try:
+        return driver.execute_script(
+            "return [window.location.origin, Object.entries(window.localStorage)]")
+    except Exception as e:
+        logging.debug(f'Error reading the local storage. {e}')
+        return None, []
+
+
+def _set_local_storage(driver: WebDriver, origin: Optional[str], items: list):
+    if not origin or origin == 'null' or len(items) == 0:
+        return
+    # the local storage of an origin can only be written from a page of that origin
+    try:
+        driver.get(origin)
+        driver.execute_script(
+            "for (const [key, value] of arguments[0]) { window.localStorage.setItem(key, value) }", items)
+    except Exception as e:
+        raise Exception(f'Error restoring the local storage of {origin}. {e}')
+
+
+def _launch_fork(proxy: Optional[dict], cookies: list, origin: Optional[str], local_storage: list) -> WebDriver:
+    driver = utils.get_webdriver(proxy)
+    try:
+        _set_all_cookies(driver, cookies)
+        _set_local_storage(driver, origin, local_storage)
+    except Exception:
+        utils.quit_webdriver(driver)
+        raise
+    return driver
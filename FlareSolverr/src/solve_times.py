@@ -0,0 +1,90 @@
+import math
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# relative error of the quantiles
+SKETCH_ACCURACY = 0.02
+# the counts are halved when they reach this number, old samples lose weight
+SKETCH_MAX_COUNT = 1000
+MAX_DOMAINS = 10000
+MIN_TIMEOUT = 5
+
+
+class QuantileSketch:
+    """Streaming quantile sketch with logarithmic buckets (like DDSketch). The quantiles have a relative
+    error of SKETCH_ACCURACY and the memory is proportional to the logarithm of the range of values."""
+
+    def __init__(self):
+        self.gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+        self.log_gamma = math.log(self.gamma)
+        self.buckets = {}
+        self.count = 0
+
+    def add(self, value: float):
+        index = math.ceil(math.log(max(value, 0.001)) / self.log_gamma)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        if self.count >= SKETCH_MAX_COUNT:
+            self.buckets = {k: v // 2 for k, v in self.buckets.items() if v > 1}
+            self.count = sum(self.buckets.values())
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                # middle of the bucket
+                return 2 * self.gamma ** index / (self.gamma + 1)
+        return None
+
+
+class SolveTimes:
+    """SolveTimes keeps the distribution of the solve times by domain. It's used to predict the solve
+    time of the requests and, if enabled, to limit the timeout to the quantile plus a margin, so hopeless
+    attempts are abandoned before maxTimeout."""
+
+    def __init__(self, adaptive: bool, quantile: float, margin: float, min_samples: int):
+        self.adaptive = adaptive
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self.sketches = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, domain: Optional[str], seconds: float):
+        """Adds a solve time, the requests that time out add the time they waited (lower bound)"""
+        if not domain:
+            return
+        with self.lock:
+            sketch = self.sketches.get(domain)
+            if sketch is None:
+                sketch = self.sketches[domain] = QuantileSketch()
+                if len(self.sketches) > MAX_DOMAINS:
+                    self.sketches.popitem(last=False)
+            else:
+                self.sketches.move_to_end(domain)
+            sketch.add(seconds)
+
+    def expected(self, domain: Optional[str]) -> Optional[float]:
+        """Median solve time in seconds, None if there are not enough samples"""
+        return self._quantile(domain, 0.5)
+
+    def timeout(self, domain: Optional[str], timeout: float) -> float:
+        """Effective timeout of the request, at most timeout"""
+        if not self.adaptive:
+            return timeout
+        learned = self._quantile(domain, self.quantile)
+        if learned is None:
+            return timeout
+        return min(timeout, max(learned * self.margin, MIN_TIMEOUT))
+
+    def _quantile(self, domain: Optional[str], q: float) -> Optional[float]:
+        with self.lock:
+            sketch = self.sketches.get(domain)
+            if sketch is None or sketch.count < self.min_samples:
+                return None
+            return sketch.quantile(q)
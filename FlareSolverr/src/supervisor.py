@@ -0,0 +1,453 @@
+import _thread
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from uuid import uuid1
+
+import requests
+from bottle import Bottle, request, response
+
+import utils
+from bottle_plugins.error_plugin import error_plugin
+from bottle_plugins.logger_plugin import logger_plugin
+from dtos import STATUS_ERROR, STATUS_OK
+from metrics import start_metrics_http_server
+
+WORKER_ID = os.environ.get('WORKER_ID', None)
+WORKER_START_TIMEOUT = 120
+WORKER_STOP_TIMEOUT = 15
+# timeout of the requests to the workers, /v1 requests wait maxTimeout plus this margin
+FORWARD_TIMEOUT = 30
+# the response headers of the workers are copied except these
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'content-encoding',
+                      'date', 'server'}
+
+
+def is_worker() -> bool:
+    return WORKER_ID is not None
+
+
+class Worker:
+    """Worker is a FlareSolverr process listening in a local port"""
+
+    def __init__(self, worker_id: int, env: dict):
+        self.worker_id = worker_id
+        self.env = env
+        self.port = None
+        self.process = None
+        self.in_flight = 0
+        self.restarting = False
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.port}'
+
+    def start(self):
+        self.port = _get_free_port()
+        env = dict(self.env)
+        env['WORKER_ID'] = str(self.worker_id)
+        env['HOST'] = '127.0.0.1'
+        env['PORT'] = str(self.port)
+        # pyinstaller binaries are executed without the script path
+        cmd = [sys.executable] if getattr(sys, 'frozen', False) else [sys.executable, os.path.abspath(sys.argv[0])]
+        self.process = subprocess.Popen(cmd, env=env)
+        logging.info(f'Worker {self.worker_id} started (pid={self.process.pid}, port={self.port})')
+
+    def wait_ready(self, http: requests.Session):
+        deadline = time.time() + WORKER_START_TIMEOUT
+        while time.time() < deadline and self.is_alive():
+            try:
+                http.get(self.url + '/health', timeout=1)
+                return
+            except requests.RequestException:
+                time.sleep(0.5)
+        logging.warning(f'Worker {self.worker_id} is not ready after {WORKER_START_TIMEOUT} seconds')
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def terminate(self):
+        # the worker finishes the requests in progress, see flaresolverr_service.shutdown
+        if self.is_alive():
+            self.process.terminate()
+
+    def wait(self, timeout: float):
+        if self.process is None:
+            return
+        try:
+            self.process.wait(max(timeout, 0))
+        except subprocess.TimeoutExpired:
+            logging.warning(f'Worker {self.worker_id} did not stop in time, killing it...')
+            self.process.kill()
+
+
+class Supervisor:
+    """Supervisor runs N FlareSolverr worker processes, each one with its own sessions and browsers,
+    and routes the /v1 requests to them. Requests with a session are routed to the worker that owns
+    the session (hash of the session id), requests without a session to the least loaded worker
+    (round-robin between the workers with the same load). Workers that die are restarted."""
+
+    def __init__(self, workers: int, prometheus_port: int = None):
+        self.lock = threading.Lock()
+        self.http = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers * 16)
+        self.http.mount('http://', adapter)
+        # sessions not created by hashing the session id (sessions.fork)
+        self.session_routes = {}
+        # worker where the next tie-break starts, async requests return immediately and always tie
+        self.next_worker = 0
+        self.draining = False
+
+        env = dict(os.environ)
+        self.prometheus_dir = None
+        if prometheus_port is not None:
+            # the workers write the metrics in this folder, the supervisor exports all of them
+            self.prometheus_dir = tempfile.mkdtemp(prefix='flaresolverr_prometheus_')
+            env['PROMETHEUS_MULTIPROC_DIR'] = self.prometheus_dir
+        self.prometheus_port = prometheus_port
+        self.workers = [Worker(i, env) for i in range(workers)]
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        for worker in self.workers:
+            worker.wait_ready(self.http)
+        if self.prometheus_dir is not None:
+            from prometheus_client import CollectorRegistry, multiprocess
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=self.prometheus_dir)
+            start_metrics_http_server(self.prometheus_port, registry)
+        threading.Thread(target=self._monitor, name='supervisor-monitor', daemon=True).start()
+
+    def stop(self, grace_seconds: float = 0):
+        self.draining = True
+        # the workers are stopped in parallel, they have some extra time to close the browsers
+        deadline = time.time() + grace_seconds + WORKER_STOP_TIMEOUT
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.wait(deadline - time.time())
+        if self.prometheus_dir is not None:
+            shutil.rmtree(self.prometheus_dir, ignore_errors=True)
+
+    def route(self, session_id: str = None) -> Worker:
+        with self.lock:
+            if session_id is None:
+                n = len(self.workers)
+                order = [self.workers[(self.next_worker + i) % n] for i in range(n)]
+                worker = min(order, key=lambda w: w.in_flight)
+                self.next_worker = (worker.worker_id + 1) % n
+            elif session_id in self.session_routes:
+                worker = self.workers[self.session_routes[session_id]]
+            else:
+                worker = self.workers[zlib.crc32(session_id.encode('utf-8')) % len(self.workers)]
+            worker.in_flight += 1
+            return worker
+
+    def route_job(self, job_id: str) -> Worker | None:
+        # the job ids start with the id of the worker, see JobsStorage
+        worker_id = job_id.split('_', 1)[0]
+        if not worker_id.isdigit() or int(worker_id) >= len(self.workers):
+            return None
+        with self.lock:
+            worker = self.workers[int(worker_id)]
+            worker.in_flight += 1
+            return worker
+
+    def forward(self, worker: Worker, method: str, path: str, data: dict = None,
+                timeout: float = FORWARD_TIMEOUT) -> requests.Response:
+        """Sends a request to the worker and reads the whole response"""
+        try:
+            return self.http.request(method, worker.url + path, json=data, timeout=timeout)
+        finally:
+            self._done(worker)
+
+    def forward_stream(self, worker: Worker, method: str, path: str, data: dict = None,
+                       timeout: float = FORWARD_TIMEOUT) -> tuple[requests.Response, 'ResponseBody']:
+        """Sends a request to the worker, the body is read as it arrives (eg: NDJSON of request.batch).
+        The request counts as in flight until the body is read or closed."""
+        try:
+            res = self.http.request(method, worker.url + path, json=data, stream=True, timeout=timeout)
+        except Exception:
+            self._done(worker)
+            raise
+        return res, ResponseBody(res, lambda: self._done(worker))
+
+    def _done(self, worker: Worker):
+        with self.lock:
+            worker.in_flight -= 1
+
+    def controller_v1(self, data: dict):
+        cmd = data.get('cmd')
+        if cmd == 'sessions.list':
+            return self._sessions_list(data)
+        if cmd == 'sessions.create' and not data.get('session'):
+            # the session id is needed to choose the worker
+            data['session'] = str(uuid1())
+        if cmd == 'request.batch' and _has_item_sessions(data):
+            # the whole batch is executed in the worker of its session
+            body = {"status": STATUS_ERROR, "message": "Error: The items of the parameter 'requests' can't have "
+                                                       "their own 'session' in multi-process mode."}
+            return 500, [('Content-Type', 'application/json')], [json.dumps(body).encode('utf-8')]
+
+        worker = self.route(data.get('session'))
+        timeout = _get_max_timeout(data) + FORWARD_TIMEOUT
+        if cmd in ('sessions.fork', 'sessions.destroy'):
+            res = self.forward(worker, 'POST', '/v1', data, timeout)
+            if res.status_code == 200:
+                with self.lock:
+                    for session_id in res.json().get('sessions') or []:
+                        self.session_routes[session_id] = worker.worker_id
+                    if cmd == 'sessions.destroy':
+                        self.session_routes.pop(data.get('session'), None)
+            return res.status_code, get_response_headers(res), [res.content]
+        res, body = self.forward_stream(worker, 'POST', '/v1', data, timeout)
+        return res.status_code, get_response_headers(res), body
+
+    def _sessions_list(self, data: dict):
+        sessions = []
+        body = None
+        for worker in self.workers:
+            with self.lock:
+                worker.in_flight += 1
+            res = self.forward(worker, 'POST', '/v1', data)
+            if res.status_code != 200:
+                return res.status_code, get_response_headers(res), [res.content]
+            body = res.json()
+            sessions += body.get('sessions') or []
+        body['sessions'] = sessions
+        return 200, [('Content-Type', 'application/json')], [json.dumps(body).encode('utf-8')]
+
+    def circuits(self) -> dict:
+        circuits = []
+        for worker in self.workers:
+            with self.lock:
+                worker.in_flight += 1
+            res = self.forward(worker, 'GET', '/v1/circuits')
+            circuits += res.json().get('circuits') or []
+        return {"status": STATUS_OK, "circuits": circuits}
+
+    def profiler(self, method: str, data: dict = None):
+        # all the workers are profiled, they write their profiles in the same folder
+        statuses = []
+        for worker in self.workers:
+            with self.lock:
+                worker.in_flight += 1
+            res = self.forward(worker, 'GET', '/v1/profiler')
+            if res.status_code != 200:
+                return res.status_code, res.json()
+            statuses.append(res.json())
+        if method == 'POST':
+            # the workers are checked first, so a failure doesn't leave some of them profiling
+            if any(status['running'] for status in statuses):
+                return 500, {"error": "The profiler is already running."}
+            statuses = []
+            for worker, worker_data in self._split_profiler_requests(data):
+                with self.lock:
+                    worker.in_flight += 1
+                res = self.forward(worker, 'POST', '/v1/profiler', worker_data)
+                if res.status_code != 200:
+                    return res.status_code, res.json()
+                statuses.append(res.json())
+        profiles = set()
+        for status in statuses:
+            profiles.update(status['profiles'])
+        return 200, {"status": STATUS_OK, "running": any(status['running'] for status in statuses),
+                     "pendingRequests": sum(status['pendingRequests'] for status in statuses),
+                     "profiles": sorted(profiles, reverse=True)}
+
+    def _split_profiler_requests(self, data: dict) -> list[tuple[Worker, dict]]:
+        """The next N requests are divided between the workers, the workers without requests are not profiled"""
+        requests = data.get('requests')
+        if requests is None or int(requests) < 1:
+            # the first worker validates the parameters
+            return [(worker, data) for worker in self.workers]
+        share, extra = divmod(int(requests), len(self.workers))
+        return [(worker, {**data, 'requests': share + (1 if i < extra else 0)})
+                for i, worker in enumerate(self.workers) if share + (1 if i < extra else 0) > 0]
+
+    def _monitor(self):
+        while True:
+            time.sleep(1)
+            for worker in self.workers:
+                if worker.is_alive() or worker.restarting or self.draining:
+                    continue
+                # the workers are restarted in parallel, a worker can take long to be ready
+                worker.restarting = True
+                threading.Thread(target=self._restart, args=(worker,), name=f'supervisor-restart-{worker.worker_id}',
+                                 daemon=True).start()
+
+    def _restart(self, worker: Worker):
+        try:
+            logging.warning(f'Worker {worker.worker_id} died (exit code {worker.process.returncode}), '
+                            f'restarting it...')
+            if self.prometheus_dir is not None:
+                from prometheus_client import multiprocess
+                multiprocess.mark_process_dead(worker.process.pid, self.prometheus_dir)
+            with self.lock:
+                # the sessions of the dead worker are lost
+                self.session_routes = {k: v for k, v in self.session_routes.items()
+                                       if v != worker.worker_id}
+            worker.start()
+            worker.wait_ready(self.http)
+        except Exception as e:
+            logging.error(f'Error restarting worker {worker.worker_id}. {e}')
+        finally:
+            worker.restarting = False
+
+
+class ResponseBody:
+    """Body of a response of a worker that is read as it arrives. The response is closed and on_close is
+    called once when the body is read completely or when the server closes it (eg: client disconnected)."""
+
+    def __init__(self, res: requests.Response, on_close):
+        self.res = res
+        self.on_close = on_close
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.res.iter_content(chunk_size=None)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.res.close()
+        self.on_close()
+
+
+def create_app(supervisor: Supervisor) -> Bottle:
+    app = Bottle()
+
+    def copy_response(res: requests.Response) -> bytes:
+        response.status = res.status_code
+        for name, value in get_response_headers(res):
+            response.set_header(name, value)
+        return res.content
+
+    @app.route('/')
+    def index():
+        worker = supervisor.route()
+        return copy_response(supervisor.forward(worker, 'GET', '/'))
+
+    @app.route('/health')
+    def health():
+        if supervisor.draining:
+            response.status = 503
+            return {"status": STATUS_ERROR}
+        return {"status": STATUS_OK}
+
+    @app.post('/v1')
+    def controller_v1():
+        if supervisor.draining:
+            response.status = 503
+            return {"status": STATUS_ERROR, "message": "Error: FlareSolverr is shutting down."}
+        data = request.json or {}
+        status, headers, body = supervisor.controller_v1(data)
+        response.status = status
+        # Content-Type, Retry-After, Server-Timing...
+        for name, value in headers:
+            response.set_header(name, value)
+        return body
+
+    @app.route('/v1/circuits')
+    def circuits():
+        return supervisor.circuits()
+
+    @app.route('/v1/recordings')
+    @app.route('/v1/recordings/<path:path>')
+    def recordings(path=None):
+        # the workers write the recordings in the same folder, any of them can read them
+        return copy_response(
+            supervisor.forward(supervisor.route(), 'GET', '/v1/recordings' + (f'/{path}' if path else '')))
+
+    @app.route('/v1/profiler')
+    def profiler():
+        status, body = supervisor.profiler('GET')
+        response.status = status
+        return body
+
+    @app.post('/v1/profiler')
+    def profiler_start():
+        status, body = supervisor.profiler('POST', request.json or {})
+        response.status = status
+        return body
+
+    @app.route('/v1/profiler/<name>')
+    def profiler_file(name):
+        return copy_response(supervisor.forward(supervisor.route(), 'GET', f'/v1/profiler/{name}'))
+
+    @app.route('/v1/jobs/<job_id>')
+    def jobs(job_id):
+        worker = supervisor.route_job(job_id)
+        if worker is None:
+            response.status = 404
+            return dict(error=f"Job '{job_id}' not found.", status_code=404)
+        # long-poll, see flaresolverr_service.jobs_endpoint
+        wait = min(max(float(request.query.get('wait', 0)), 0), 300)
+        return copy_response(supervisor.forward(worker, 'GET', f'/v1/jobs/{job_id}?{request.query_string}',
+                                                timeout=wait + FORWARD_TIMEOUT))
+
+    app.install(logger_plugin)
+    app.install(error_plugin)
+    return app
+
+
+def run(host: str, port: int, workers: int, prometheus_port: int = None):
+    logging.info(f'Starting supervisor with {workers} workers')
+    supervisor = Supervisor(workers, prometheus_port)
+    supervisor.start()
+
+    def shutdown(signum, frame):
+        def drain():
+            supervisor.stop(utils.get_config_shutdown_grace_seconds())
+            # stops the server (KeyboardInterrupt in the main thread)
+            _thread.interrupt_main()
+        logging.info(f"Signal {signal.Signals(signum).name} received")
+        threading.Thread(target=drain, name='shutdown', daemon=True).start()
+    signal.signal(signal.SIGTERM, shutdown)
+
+    try:
+        from waitress import serve
+        # each request holds a thread until the worker responds
+        serve(create_app(supervisor), host=host, port=port, threads=workers * 4, asyncore_use_poll=True)
+    finally:
+        supervisor.stop()
+
+
+def get_response_headers(res: requests.Response) -> list[tuple[str, str]]:
+    return [(name, value) for name, value in res.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS]
+
+
+def _has_item_sessions(data: dict) -> bool:
+    items = data.get('requests')
+    if not isinstance(items, list):
+        return False
+    return any(isinstance(item, dict) and item.get('session') not in (None, data.get('session')) for item in items)
+
+
+def _get_max_timeout(data: dict) -> float:
+    """maxTimeout of a /v1 request in seconds, see flaresolverr_service._controller_v1_handler"""
+    try:
+        max_timeout = int(data.get('maxTimeout') or 0)
+    except (TypeError, ValueError):
+        max_timeout = 0
+    return (max_timeout if max_timeout >= 1 else 60000) / 1000
+
+
+def _get_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
@@ -1,9 +1,11 @@
+import json
+import os
 import unittest
 from typing import Optional
 
 from webtest import TestApp
 
-from dtos import IndexResponse, HealthResponse, V1ResponseBase, STATUS_OK, STATUS_ERROR
+from dtos import IndexResponse, HealthResponse, JobResponse, V1ResponseBase, STATUS_OK, STATUS_ERROR
 import flaresolverr
 import utils
 
@@ -115,6 +117,21 @@ class TestFlareSolverr(unittest.TestCase):
         self.assertGreater(len(solution.cookies), 0)
         self.assertIn("Chrome/", solution.userAgent)
 
+    def test_v1_endpoint_request_get_return_timings(self):
+        res = self.app.post_json("/v1", {
+            "cmd": "request.get",
+            "url": self.google_url,
+            "returnTimings": True
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("navigation;dur=", res.headers['Server-Timing'])
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_OK, body.status)
+        self.assertIn("navigation", body.timings['phases'])
+        self.assertGreater(body.timings['webdriverCommands'], 0)
+        self.assertGreaterEqual(body.timings['total'], body.timings['phases']['navigation'])
+
     def test_v1_endpoint_request_get_cloudflare_js_1(self):
         res = self.app.post_json('/v1', {
             "cmd": "request.get",
@@ -444,6 +461,20 @@ class TestFlareSolverr(unittest.TestCase):
         self.assertGreaterEqual(body.endTimestamp, body.startTimestamp)
         self.assertEqual(utils.get_flaresolverr_version(), body.version)
 
+    def test_v1_endpoint_request_get_proxy_pool_not_found(self):
+        res = self.app.post_json('/v1', {
+            "cmd": "request.get",
+            "url": self.google_url,
+            "proxy": {
+                "pool": "nonexistent"
+            }
+        }, status=500)
+        self.assertEqual(res.status_code, 500)
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_ERROR, body.status)
+        self.assertEqual("Error: Error solving the challenge. Proxy pool 'nonexistent' doesn't exist.", body.message)
+
     def test_v1_endpoint_request_get_fail_timeout(self):
         res = self.app.post_json('/v1', {
             "cmd": "request.get",
@@ -556,6 +587,73 @@ class TestFlareSolverr(unittest.TestCase):
         self.assertEqual(STATUS_OK, body.status)
         self.assertEqual("Challenge not detected!", body.message)
 
+    def test_v1_endpoint_request_batch(self):
+        res = self.app.post_json('/v1', {
+            "cmd": "request.batch",
+            "concurrency": 2,
+            "requests": [
+                {"cmd": "request.get", "url": self.google_url},
+                {"cmd": "request.get", "url": self.google_url, "returnOnlyCookies": True},
+                {"cmd": "request.post", "url": self.post_url, "postData": "param1=value1&param2=value2"}
+            ]
+        })
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content_type, "application/x-ndjson")
+
+        items = [V1ResponseBase(json.loads(line)) for line in res.text.splitlines()]
+        self.assertEqual(len(items), 3)
+        self.assertEqual([0, 1, 2], sorted(item.index for item in items))
+        for item in items:
+            self.assertEqual(STATUS_OK, item.status)
+            self.assertEqual("Challenge not detected!", item.message)
+        item = _find_obj_by_key("index", 1, [item.__dict__ for item in items])
+        self.assertIsNone(item["solution"].response)
+
+    def test_v1_endpoint_request_batch_fail_no_requests(self):
+        res = self.app.post_json('/v1', {
+            "cmd": "request.batch"
+        }, status=500)
+        self.assertEqual(res.status_code, 500)
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_ERROR, body.status)
+        self.assertEqual("Error: Request parameter 'requests' is mandatory in 'request.batch' command.", body.message)
+
+    def test_v1_endpoint_request_get_async(self):
+        res = self.app.post_json('/v1', {
+            "cmd": "request.get",
+            "url": self.google_url,
+            "async": True
+        })
+        self.assertEqual(res.status_code, 200)
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_OK, body.status)
+        self.assertEqual("Job created.", body.message)
+        self.assertIsNotNone(body.job)
+
+        res = self.app.get('/v1/jobs/' + body.job + '?wait=60')
+        self.assertEqual(res.status_code, 200)
+
+        job = JobResponse(res.json)
+        self.assertEqual(body.job, job.job)
+        self.assertEqual("done", job.status)
+        result = V1ResponseBase(job.result)
+        self.assertEqual(STATUS_OK, result.status)
+        self.assertEqual("Challenge not detected!", result.message)
+        self.assertIn("<title>Google</title>", result.solution.response)
+
+    def test_v1_endpoint_jobs_non_existing_job(self):
+        res = self.app.get('/v1/jobs/non_existing_job', status=404)
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual("Job 'non_existing_job' not found.", res.json['error'])
+
+    def test_v1_endpoint_circuits(self):
+        res = self.app.get('/v1/circuits')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(STATUS_OK, res.json['status'])
+        self.assertIsInstance(res.json['circuits'], list)
+
     def test_v1_endpoint_sessions_create_without_session(self):
         res = self.app.post_json('/v1', {
             "cmd": "sessions.create"
@@ -635,6 +733,52 @@ class TestFlareSolverr(unittest.TestCase):
         self.assertEqual(STATUS_ERROR, body.status)
         self.assertEqual("Error: The session doesn't exist.", body.message)
 
+    def test_v1_endpoint_sessions_fork(self):
+        self.app.post_json('/v1', {
+            "cmd": "sessions.create",
+            "session": "test_fork_sessions"
+        })
+        res = self.app.post_json('/v1', {
+            "cmd": "request.get",
+            "session": "test_fork_sessions",
+            "url": self.google_url
+        })
+        source_body = V1ResponseBase(res.json)
+        res = self.app.post_json('/v1', {
+            "cmd": "sessions.fork",
+            "session": "test_fork_sessions",
+            "count": 2
+        })
+        self.assertEqual(res.status_code, 200)
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_OK, body.status)
+        self.assertEqual("The session has been forked.", body.message)
+        self.assertEqual(len(body.sessions), 2)
+
+        res = self.app.post_json('/v1', {
+            "cmd": "request.get",
+            "session": body.sessions[0],
+            "url": self.google_url
+        })
+        fork_body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_OK, fork_body.status)
+        source_cookie = _find_obj_by_key("name", "NID", source_body.solution.cookies)
+        fork_cookie = _find_obj_by_key("name", "NID", fork_body.solution.cookies)
+        self.assertIsNotNone(fork_cookie)
+        self.assertEqual(source_cookie["value"], fork_cookie["value"])
+
+    def test_v1_endpoint_sessions_fork_non_existing_session(self):
+        res = self.app.post_json('/v1', {
+            "cmd": "sessions.fork",
+            "session": "non_existing_session_name"
+        }, status=500)
+        self.assertEqual(res.status_code, 500)
+
+        body = V1ResponseBase(res.json)
+        self.assertEqual(STATUS_ERROR, body.status)
+        self.assertEqual("Error: The session doesn't exist.", body.message)
+
     def test_v1_endpoint_request_get_with_session(self):
         self.app.post_json('/v1', {
             "cmd": "sessions.create",
@@ -650,6 +794,37 @@ class TestFlareSolverr(unittest.TestCase):
         body = V1ResponseBase(res.json)
         self.assertEqual(STATUS_OK, body.status)
 
+    def test_v1_endpoint_request_get_with_session_recycled(self):
+        os.environ['SESSION_RECYCLE_REQUESTS'] = '1'
+        try:
+            self.app.post_json('/v1', {
+                "cmd": "sessions.create",
+                "session": "test_recycle_sessions"
+            })
+            res1 = self.app.post_json('/v1', {
+                "cmd": "request.get",
+                "session": "test_recycle_sessions",
+                "url": self.google_url
+            })
+            # the second request relaunches the browser
+            res2 = self.app.post_json('/v1', {
+                "cmd": "request.get",
+                "session": "test_recycle_sessions",
+                "url": self.google_url
+            })
+        finally:
+            del os.environ['SESSION_RECYCLE_REQUESTS']
+        self.assertEqual(res2.status_code, 200)
+
+        body1 = V1ResponseBase(res1.json)
+        body2 = V1ResponseBase(res2.json)
+        self.assertEqual(STATUS_OK, body2.status)
+        self.assertEqual(body1.solution.userAgent, body2.solution.userAgent)
+        cookie1 = _find_obj_by_key("name", "NID", body1.solution.cookies)
+        cookie2 = _find_obj_by_key("name", "NID", body2.solution.cookies)
+        self.assertIsNotNone(cookie2)
+        self.assertEqual(cookie1["value"], cookie2["value"])
+
 
 if __name__ == '__main__':
     unittest.main()
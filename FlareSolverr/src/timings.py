@@ -0,0 +1,59 @@
+import contextvars
+import time
+from typing import Optional
+
+# timings of the request in progress, None if they are not collected
+TIMINGS = contextvars.ContextVar('timings', default=None)
+
+
+class Timings:
+    """Timings collects the duration of the phases of a request and the number of WebDriver commands
+    (roundtrips to chromedriver). The phases executed more than once (eg: navigation) are added up.
+    The threads started by the request must run in a copy of its context (contextvars.copy_context)."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # phase => seconds, in order of execution
+        self.phases = {}
+        self.webdriver_commands = 0
+        # command => [count, seconds]
+        self.commands = {}
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def add_command(self, command: str, seconds: float):
+        self.webdriver_commands += 1
+        stats = self.commands.setdefault(command, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def commands_summary(self) -> str:
+        """The WebDriver commands of the request, the slowest first"""
+        commands = sorted(self.commands.items(), key=lambda item: item[1][1], reverse=True)
+        return ', '.join(f'{command} x{count} {seconds * 1000:.1f} ms' for command, (count, seconds) in commands)
+
+    def to_dict(self) -> dict:
+        """Milliseconds of each phase and of the whole request"""
+        return {
+            "total": round((time.perf_counter() - self.start) * 1000, 1),
+            "phases": {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()},
+            "webdriverCommands": self.webdriver_commands,
+            "webdriver": {command: {"count": count, "ms": round(seconds * 1000, 1)}
+                          for command, (count, seconds) in self.commands.items()}
+        }
+
+
+def get_timings() -> Optional[Timings]:
+    return TIMINGS.get()
+
+
+def server_timing(timings: dict, serialization: Optional[float] = None) -> str:
+    """Value of the Server-Timing header of the timings of a response (Timings.to_dict).
+    serialization is the seconds serializing the response, it's not included in the total."""
+    metrics = [f'{name};dur={ms}' for name, ms in timings['phases'].items()]
+    if serialization is not None:
+        metrics.append(f'serialization;dur={round(serialization * 1000, 1)}')
+    metrics.append(f'webdriver;desc="{timings["webdriverCommands"]} commands"')
+    metrics.append(f'total;dur={timings["total"]}')
+    return ', '.join(metrics)
@@ -1,3 +1,4 @@
+import hashlib
 import json
 import logging
 import os
@@ -6,10 +7,19 @@ import re
 import shutil
 import sys
 import tempfile
+import threading
+import time
 import urllib.parse
+from collections import Counter
 
+import psutil
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.webdriver import WebDriver
 import undetected_chromedriver as uc
+from metrics import (BROWSER_CRASHES, BROWSER_LAUNCHES, BROWSERS, PROMETHEUS_ENABLED, WEBDRIVER_COMMAND_DURATION,
+                     observe_phase)
+from timings import get_timings
 
 FLARESOLVERR_VERSION = None
 PLATFORM_VERSION = None
@@ -18,12 +28,35 @@ CHROME_MAJOR_VERSION = None
 USER_AGENT = None
 XVFB_DISPLAY = None
 PATCHED_DRIVER_PATH = None
+PROXY_FORWARDER = None
+PROXY_FORWARDER_LOCK = threading.Lock()
+# the pid of the owner process is in the name of the profile folder, see reaper.py
+PROFILE_DIR_PREFIX = 'flaresolverr_profile_'
+# folders used by the browsers of this process (they may be shared)
+LIVE_DIRS = Counter()
+LIVE_DIRS_LOCK = threading.Lock()
 
 
 def get_config_log_html() -> bool:
     return os.environ.get('LOG_HTML', 'false').lower() == 'true'
 
 
+def get_config_log_json() -> bool:
+    return os.environ.get('LOG_JSON', 'false').lower() == 'true'
+
+
+def get_config_log_max_field_length() -> int:
+    return int(os.environ.get('LOG_MAX_FIELD_LENGTH', 1000))
+
+
+def get_config_log_sample_max_lines() -> int:
+    return int(os.environ.get('LOG_SAMPLE_MAX_LINES', 0))
+
+
+def get_config_log_sample_seconds() -> int:
+    return int(os.environ.get('LOG_SAMPLE_SECONDS', 60))
+
+
 def get_config_headless() -> bool:
     return os.environ.get('HEADLESS', 'true').lower() == 'true'
 
@@ -32,6 +65,198 @@ def get_config_disable_media() -> bool:
     return os.environ.get('DISABLE_MEDIA', 'false').lower() == 'true'
 
 
+def get_config_session_recycle_requests() -> int:
+    return int(os.environ.get('SESSION_RECYCLE_REQUESTS', 0))
+
+
+def get_config_session_recycle_minutes() -> int:
+    return int(os.environ.get('SESSION_RECYCLE_MINUTES', 0))
+
+
+def get_config_session_recycle_rss_mb() -> int:
+    return int(os.environ.get('SESSION_RECYCLE_RSS_MB', 0))
+
+
+def get_config_session_max_tabs() -> int:
+    return max(int(os.environ.get('SESSION_MAX_TABS', 1)), 1)
+
+
+def get_config_session_freeze_idle_seconds() -> int:
+    return int(os.environ.get('SESSION_FREEZE_IDLE_SECONDS', 0))
+
+
+def get_config_session_fork_max() -> int:
+    return int(os.environ.get('SESSION_FORK_MAX', 10))
+
+
+def get_config_session_hygiene() -> list[str]:
+    hygiene = os.environ.get('SESSION_HYGIENE', '').lower()
+    return [option.strip() for option in hygiene.split(',') if option.strip()]
+
+
+def get_config_workers() -> int:
+    return max(int(os.environ.get('WORKERS', 1)), 1)
+
+
+def get_config_batch_max_concurrency() -> int:
+    return max(int(os.environ.get('BATCH_MAX_CONCURRENCY', 4)), 1)
+
+
+def get_config_jobs_max_concurrency() -> int:
+    return max(int(os.environ.get('JOBS_MAX_CONCURRENCY', 4)), 1)
+
+
+def get_config_jobs_max() -> int:
+    return int(os.environ.get('JOBS_MAX', 10000))
+
+
+def get_config_jobs_ttl_seconds() -> int:
+    return int(os.environ.get('JOBS_TTL_SECONDS', 300))
+
+
+def get_config_request_coalescing() -> bool:
+    return os.environ.get('REQUEST_COALESCING', 'false').lower() == 'true'
+
+
+def get_config_browser_pool_size() -> int:
+    return int(os.environ.get('BROWSER_POOL_SIZE', 0))
+
+
+def get_config_browser_pool_idle_seconds() -> int:
+    return int(os.environ.get('BROWSER_POOL_IDLE_SECONDS', 300))
+
+
+def get_config_proxy_forwarder() -> bool:
+    return os.environ.get('PROXY_FORWARDER', 'false').lower() == 'true'
+
+
+def get_config_proxy_pools() -> dict:
+    # JSON or path to a JSON file. Eg: {"pool1": ["http://127.0.0.1:8888", {"url": "socks5://...", ...}]}
+    proxy_pools = os.environ.get('PROXY_POOLS', '').strip()
+    if not proxy_pools:
+        return {}
+    if not proxy_pools.startswith('{'):
+        with open(proxy_pools) as f:
+            proxy_pools = f.read()
+    return json.loads(proxy_pools)
+
+
+def get_config_proxy_health_check_url() -> str:
+    return os.environ.get('PROXY_HEALTH_CHECK_URL', 'https://www.google.com/generate_204')
+
+
+def get_config_proxy_health_check_seconds() -> int:
+    return int(os.environ.get('PROXY_HEALTH_CHECK_SECONDS', 60))
+
+
+def get_config_proxy_eject_blocks() -> int:
+    return max(int(os.environ.get('PROXY_EJECT_BLOCKS', 3)), 1)
+
+
+def get_config_proxy_eject_minutes() -> int:
+    return int(os.environ.get('PROXY_EJECT_MINUTES', 10))
+
+
+def get_config_circuit_breaker_failures() -> int:
+    return int(os.environ.get('CIRCUIT_BREAKER_FAILURES', 0))
+
+
+def get_config_circuit_breaker_cooldown_seconds() -> int:
+    return int(os.environ.get('CIRCUIT_BREAKER_COOLDOWN_SECONDS', 300))
+
+
+def get_config_adaptive_timeout() -> bool:
+    return os.environ.get('ADAPTIVE_TIMEOUT', 'false').lower() == 'true'
+
+
+def get_config_adaptive_timeout_quantile() -> float:
+    return float(os.environ.get('ADAPTIVE_TIMEOUT_QUANTILE', 0.99))
+
+
+def get_config_adaptive_timeout_margin() -> float:
+    return float(os.environ.get('ADAPTIVE_TIMEOUT_MARGIN', 1.5))
+
+
+def get_config_adaptive_timeout_min_samples() -> int:
+    return int(os.environ.get('ADAPTIVE_TIMEOUT_MIN_SAMPLES', 20))
+
+
+def get_config_max_concurrent_solves() -> int:
+    return int(os.environ.get('MAX_CONCURRENT_SOLVES', 0))
+
+
+def get_config_domain_max_concurrency() -> dict:
+    # number (all domains) or JSON. Eg: {"*": 2, "www.example.com": 1}
+    domain_max_concurrency = os.environ.get('DOMAIN_MAX_CONCURRENCY', '0').strip()
+    if domain_max_concurrency.startswith('{'):
+        return {k: int(v) for k, v in json.loads(domain_max_concurrency).items()}
+    return {'*': int(domain_max_concurrency)}
+
+
+def get_config_scheduler_weights() -> dict:
+    # JSON with the weight of the client tags. Eg: {"*": 1, "premium": 3}
+    scheduler_weights = os.environ.get('SCHEDULER_WEIGHTS', '').strip()
+    if not scheduler_weights:
+        return {}
+    return {k: float(v) for k, v in json.loads(scheduler_weights).items()}
+
+
+def get_config_rate_limit_domain() -> float:
+    return float(os.environ.get('RATE_LIMIT_DOMAIN', 0))
+
+
+def get_config_rate_limit_proxy() -> float:
+    return float(os.environ.get('RATE_LIMIT_PROXY', 0))
+
+
+def get_config_rate_limit_domain_proxy() -> float:
+    return float(os.environ.get('RATE_LIMIT_DOMAIN_PROXY', 0))
+
+
+def get_config_rate_limit_burst() -> int:
+    return int(os.environ.get('RATE_LIMIT_BURST', 1))
+
+
+def get_config_reaper_interval_seconds() -> int:
+    return int(os.environ.get('REAPER_INTERVAL_SECONDS', 300))
+
+
+def get_config_shutdown_grace_seconds() -> int:
+    return int(os.environ.get('SHUTDOWN_GRACE_SECONDS', 30))
+
+
+def get_config_profiles_dir() -> str:
+    return os.environ.get('PROFILES_DIR', '/config/profiles')
+
+
+def get_config_profiles_max_files() -> int:
+    return int(os.environ.get('PROFILES_MAX_FILES', 20))
+
+
+def get_config_flight_recorder() -> bool:
+    return os.environ.get('FLIGHT_RECORDER', 'false').lower() == 'true'
+
+
+def get_config_flight_recorder_dir() -> str:
+    return os.environ.get('FLIGHT_RECORDER_DIR', '/config/recordings')
+
+
+def get_config_flight_recorder_slow_seconds() -> float:
+    return float(os.environ.get('FLIGHT_RECORDER_SLOW_SECONDS', 30))
+
+
+def get_config_flight_recorder_max_mb() -> int:
+    return int(os.environ.get('FLIGHT_RECORDER_MAX_MB', 100))
+
+
+def get_config_flight_recorder_html_kb() -> int:
+    return int(os.environ.get('FLIGHT_RECORDER_HTML_KB', 256))
+
+
+def get_config_flight_recorder_screenshot() -> bool:
+    return os.environ.get('FLIGHT_RECORDER_SCREENSHOT', 'false').lower() == 'true'
+
+
 def get_flaresolverr_version() -> str:
     global FLARESOLVERR_VERSION
     if FLARESOLVERR_VERSION is not None:
@@ -52,7 +277,7 @@ def get_current_platform() -> str:
     return PLATFORM_VERSION
 
 
-def create_proxy_extension(proxy: dict) -> str:
+def create_proxy_extension(proxy: dict, proxy_extension_dir: str) -> str:
     parsed_url = urllib.parse.urlparse(proxy['url'])
     scheme = parsed_url.scheme
     host = parsed_url.hostname
@@ -118,7 +343,8 @@ def create_proxy_extension(proxy: dict) -> str:
         password
     )
 
-    proxy_extension_dir = tempfile.mkdtemp()
+    # the folder contains the proxy password
+    os.makedirs(proxy_extension_dir, mode=0o700)
 
     with open(os.path.join(proxy_extension_dir, "manifest.json"), "w") as f:
         f.write(manifest_json)
@@ -129,9 +355,18 @@ def create_proxy_extension(proxy: dict) -> str:
     return proxy_extension_dir
 
 
+def get_proxy_key(proxy: dict = None) -> str:
+    """Returns a hash that identifies the proxy configuration ('' without proxy)."""
+    if not proxy or not proxy.get('url'):
+        return ''
+    proxy_config = [proxy.get('url'), proxy.get('username'), proxy.get('password')]
+    return hashlib.sha256(json.dumps(proxy_config).encode('utf-8')).hexdigest()[:32]
+
+
 def get_webdriver(proxy: dict = None) -> WebDriver:
     global PATCHED_DRIVER_PATH, USER_AGENT
     logging.debug('Launching web browser...')
+    launch_start = time.perf_counter()
 
     # undetected_chromedriver
     options = uc.ChromeOptions()
@@ -158,62 +393,91 @@ def get_webdriver(proxy: dict = None) -> WebDriver:
     if USER_AGENT is not None:
         options.add_argument('--user-agent=%s' % USER_AGENT)
 
+    # the profile folder is removed by driver.quit()
+    user_data_dir = os.path.normpath(tempfile.mkdtemp(prefix=f'{PROFILE_DIR_PREFIX}{os.getpid()}_'))
+    live_dirs = [user_data_dir]
+    _add_live_dirs(live_dirs)
+
     proxy_extension_dir = None
-    if proxy and all(key in proxy for key in ['url', 'username', 'password']):
-        proxy_extension_dir = create_proxy_extension(proxy)
-        options.add_argument("--disable-features=DisableLoadExtensionCommandLineSwitch")
-        options.add_argument("--load-extension=%s" % os.path.abspath(proxy_extension_dir))
-    elif proxy and 'url' in proxy:
-        proxy_url = proxy['url']
-        logging.debug("Using webdriver proxy: %s", proxy_url)
-        options.add_argument('--proxy-server=%s' % proxy_url)
-
-    # note: headless mode is detected (headless = True)
-    # we launch the browser in head-full mode with the window hidden
-    windows_headless = False
-    if get_config_headless():
-        if os.name == 'nt':
-            windows_headless = True
+    proxy_route = None
+    driver = None
+    try:
+        if get_config_proxy_forwarder():
+            # the browser always uses the local forwarder, the upstream proxy can be changed later
+            proxy_route = get_proxy_forwarder().add_route(proxy)
+            options.add_argument('--proxy-server=%s' % proxy_route.proxy_server)
+        elif proxy and all(key in proxy for key in ['url', 'username', 'password']):
+            # inside the private profile folder, so it's removed with it if the browser is not closed properly
+            proxy_extension_dir = create_proxy_extension(proxy, os.path.join(user_data_dir, 'proxy_extension'))
+            options.add_argument("--disable-features=DisableLoadExtensionCommandLineSwitch")
+            options.add_argument("--load-extension=%s" % os.path.abspath(proxy_extension_dir))
+        elif proxy and 'url' in proxy:
+            proxy_url = proxy['url']
+            logging.debug("Using webdriver proxy: %s", proxy_url)
+            options.add_argument('--proxy-server=%s' % proxy_url)
+
+        # note: headless mode is detected (headless = True)
+        # we launch the browser in head-full mode with the window hidden
+        windows_headless = False
+        if get_config_headless():
+            if os.name == 'nt':
+                windows_headless = True
+            else:
+                start_xvfb_display()
+        # For normal headless mode:
+        # options.add_argument('--headless')
+
+        # if we are inside the Docker container, we avoid downloading the driver
+        driver_exe_path = None
+        version_main = None
+        if os.path.exists("/app/chromedriver"):
+            # running inside Docker
+            driver_exe_path = "/app/chromedriver"
         else:
-            start_xvfb_display()
-    # For normal headless mode:
-    # options.add_argument('--headless')
-
-    # if we are inside the Docker container, we avoid downloading the driver
-    driver_exe_path = None
-    version_main = None
-    if os.path.exists("/app/chromedriver"):
-        # running inside Docker
-        driver_exe_path = "/app/chromedriver"
-    else:
-        version_main = get_chrome_major_version()
-        if PATCHED_DRIVER_PATH is not None:
-            driver_exe_path = PATCHED_DRIVER_PATH
+            version_main = get_chrome_major_version()
+            if PATCHED_DRIVER_PATH is not None:
+                driver_exe_path = PATCHED_DRIVER_PATH
 
-    # detect chrome path
-    browser_executable_path = get_chrome_exe_path()
+        # detect chrome path
+        browser_executable_path = get_chrome_exe_path()
 
-    # downloads and patches the chromedriver
-    # if we don't set driver_executable_path it downloads, patches, and deletes the driver each time
-    try:
+        # downloads and patches the chromedriver
+        # if we don't set driver_executable_path it downloads, patches, and deletes the driver each time
         driver = uc.Chrome(options=options, browser_executable_path=browser_executable_path,
                            driver_executable_path=driver_exe_path, version_main=version_main,
-                           windows_headless=windows_headless, headless=get_config_headless())
+                           windows_headless=windows_headless, headless=get_config_headless(),
+                           user_data_dir=user_data_dir)
+
+        # the extension is loaded, the proxy credentials are not kept on disk
+        if proxy_extension_dir is not None:
+            shutil.rmtree(proxy_extension_dir, ignore_errors=True)
+
+        _trace_webdriver_commands(driver)
+        # the profile is temporary although it's created here
+        driver.keep_user_data_dir = False
+        driver.live_dirs = live_dirs
+        driver.proxy_route = proxy_route
+
+        # save the patched driver to avoid re-downloads
+        if driver_exe_path is None:
+            PATCHED_DRIVER_PATH = os.path.join(driver.patcher.data_path, driver.patcher.exe_name)
+            if PATCHED_DRIVER_PATH != driver.patcher.executable_path:
+                shutil.copy(driver.patcher.executable_path, PATCHED_DRIVER_PATH)
     except Exception as e:
         logging.error("Error starting Chrome: %s" % e)
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+        _remove_live_dirs(live_dirs)
+        shutil.rmtree(user_data_dir, ignore_errors=True)
+        if proxy_route is not None:
+            proxy_route.close()
+        BROWSER_LAUNCHES.labels(result='error').inc()
         # No point in continuing if we cannot retrieve the driver
         raise e
 
-    # save the patched driver to avoid re-downloads
-    if driver_exe_path is None:
-        PATCHED_DRIVER_PATH = os.path.join(driver.patcher.data_path, driver.patcher.exe_name)
-        if PATCHED_DRIVER_PATH != driver.patcher.executable_path:
-            shutil.copy(driver.patcher.executable_path, PATCHED_DRIVER_PATH)
-
-    # clean up proxy extension directory
-    if proxy_extension_dir is not None:
-        shutil.rmtree(proxy_extension_dir)
-
     # selenium vanilla
     # options = webdriver.ChromeOptions()
     # options.add_argument('--no-sandbox')
@@ -222,9 +486,167 @@ def get_webdriver(proxy: dict = None) -> WebDriver:
     # options.add_argument('--disable-dev-shm-usage')
     # driver = webdriver.Chrome(options=options)
 
+    BROWSER_LAUNCHES.labels(result='ok').inc()
+    BROWSERS.inc()
+    observe_phase('launch', time.perf_counter() - launch_start)
     return driver
 
 
+def get_webdriver_tab(driver: WebDriver) -> WebDriver:
+    """
+    Opens a new tab in the browser of the driver and returns a new WebDriver attached to that tab.
+    The new WebDriver uses its own chromedriver process, so it can be used concurrently with
+    the original one. The tabs share the cookies because they are in the same browser profile.
+    """
+    logging.debug('Opening a new browser tab...')
+    options = webdriver.ChromeOptions()
+    options.debugger_address = driver.options.debugger_address
+    service = Service(executable_path=driver.service.path)
+    tab = webdriver.Chrome(options=options, service=service)
+    _trace_webdriver_commands(tab)
+    tab.switch_to.new_window('tab')
+    return tab
+
+
+def _trace_webdriver_commands(driver: WebDriver):
+    """
+    Measures the WebDriver commands of the driver (count and duration by command) for the Prometheus metrics
+    and the timings of the request (returned and logged in debug level). All the commands (including CDP) are
+    sent to chromedriver by the command executor. Nothing is measured if none of them is enabled.
+    """
+    execute = driver.command_executor.execute
+
+    def traced_execute(command, params):
+        timings = get_timings()
+        if timings is None and not PROMETHEUS_ENABLED:
+            return execute(command, params)
+        # the CDP commands are told apart
+        name = f"{command}:{params.get('cmd')}" if command == 'executeCdpCommand' and params else command
+        start = time.perf_counter()
+        try:
+            return execute(command, params)
+        finally:
+            seconds = time.perf_counter() - start
+            if timings is not None:
+                timings.add_command(name, seconds)
+            if PROMETHEUS_ENABLED:
+                WEBDRIVER_COMMAND_DURATION.labels(command=name).observe(seconds)
+    driver.command_executor.execute = traced_execute
+
+
+def close_webdriver_tab(tab: WebDriver):
+    # the browser is not closed because the chromedriver is attached to it
+    try:
+        tab.close()
+    except Exception as e:
+        logging.debug(f'Error closing the browser tab. {e}')
+    tab.quit()
+
+
+def quit_webdriver(driver: WebDriver):
+    if not _is_browser_running(driver):
+        logging.warning('The web browser has crashed')
+        BROWSER_CRASHES.inc()
+    BROWSERS.dec()
+    if PLATFORM_VERSION == "nt":
+        driver.close()
+    driver.quit()
+    _remove_live_dirs(getattr(driver, 'live_dirs', []))
+    proxy_route = getattr(driver, 'proxy_route', None)
+    if proxy_route is not None:
+        proxy_route.close()
+
+
+def get_live_dirs() -> set:
+    with LIVE_DIRS_LOCK:
+        return set(LIVE_DIRS)
+
+
+def _add_live_dirs(dirs: list):
+    with LIVE_DIRS_LOCK:
+        LIVE_DIRS.update(dirs)
+
+
+def _remove_live_dirs(dirs: list):
+    with LIVE_DIRS_LOCK:
+        LIVE_DIRS.subtract(dirs)
+        for d in dirs:
+            if LIVE_DIRS[d] <= 0:
+                del LIVE_DIRS[d]
+
+
+def get_proxy_forwarder():
+    global PROXY_FORWARDER
+    if PROXY_FORWARDER is None:
+        # the first requests may arrive at the same time
+        with PROXY_FORWARDER_LOCK:
+            if PROXY_FORWARDER is None:
+                from proxy_forwarder import ProxyForwarder
+                PROXY_FORWARDER = ProxyForwarder()
+    return PROXY_FORWARDER
+
+
+def set_webdriver_proxy(driver: WebDriver, proxy: dict = None) -> bool:
+    """
+    Changes the upstream proxy of a browser launched with the proxy forwarder.
+    Returns False if the browser doesn't use the forwarder (the proxy can't be changed).
+    """
+    proxy_route = getattr(driver, 'proxy_route', None)
+    if proxy_route is None:
+        return False
+    proxy_route.set_upstream(proxy)
+    return True
+
+
+def _get_webdriver_processes(driver: WebDriver) -> list:
+    browser_pid = getattr(driver, 'browser_pid', None)
+    if browser_pid is None:
+        return []
+    try:
+        browser_process = psutil.Process(browser_pid)
+        return [browser_process] + browser_process.children(recursive=True)
+    except psutil.Error:
+        return []
+
+
+def _is_browser_running(driver: WebDriver) -> bool:
+    browser_pid = getattr(driver, 'browser_pid', None)
+    if browser_pid is None:
+        return True
+    try:
+        return psutil.Process(browser_pid).status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+
+def get_webdriver_rss(driver: WebDriver) -> int:
+    """
+    Returns the resident memory (in bytes) of the browser process and all its children.
+    Returns 0 if the browser process is not known or already dead.
+    """
+    rss = 0
+    for process in _get_webdriver_processes(driver):
+        try:
+            rss += process.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def get_webdriver_cpu_time(driver: WebDriver) -> float:
+    """
+    Returns the CPU time (user + system, in seconds) consumed by the browser process and all its children.
+    """
+    cpu_time = 0.0
+    for process in _get_webdriver_processes(driver):
+        try:
+            cpu_times = process.cpu_times()
+            cpu_time += cpu_times.user + cpu_times.system
+        except psutil.Error:
+            pass
+    return cpu_time
+
+
 def get_chrome_exe_path() -> str:
     global CHROME_EXE_PATH
     if CHROME_EXE_PATH is not None:
@@ -328,9 +750,7 @@ def get_user_agent(driver=None) -> str:
         raise Exception("Error getting browser User-Agent. " + str(e))
     finally:
         if driver is not None:
-            if PLATFORM_VERSION == "nt":
-                driver.close()
-            driver.quit()
+            quit_webdriver(driver)
 
 
 def start_xvfb_display():
@@ -342,6 +762,8 @@ def start_xvfb_display():
 
 
 def object_to_dict(_object):
-    json_dict = json.loads(json.dumps(_object, default=lambda o: o.__dict__))
+    # hidden fields are skipped because they may not be serializable
+    json_dict = json.loads(json.dumps(
+        _object, default=lambda o: {k: v for k, v in o.__dict__.items() if not k.startswith('__')}))
     # remove hidden fields
     return {k: v for k, v in json_dict.items() if not k.startswith('__')}